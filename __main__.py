@@ -1,5 +1,14 @@
-from app import main
+import sys
+
+from timing import STARTUP
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # Служебные команды работают без графического интерфейса и не загружают toga
+        from cli import main as cli_main
+        sys.exit(cli_main(sys.argv[1:]))
+
+    from app import main
+    STARTUP.mark('импорт toga и app')
     app = main()
-    app.main_loop() 
\ No newline at end of file
+    app.main_loop()
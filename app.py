@@ -1,7 +1,15 @@
+import threading
 import toga
 from toga.style import Pack
 from toga.style.pack import COLUMN, ROW
 from database import Database
+from writer import BackgroundWriter
+from autocomplete import PrefixIndex
+from form_model import FormTotals, clean_positive_integer
+from fields import BASIC_FIELDS, DEFECT_CATEGORIES
+from spc import SPCEngine
+from timing import STARTUP
+from metrics import METRICS
 from datetime import datetime
 
 class CastingQualityControl(toga.App):
@@ -13,6 +21,14 @@ class CastingQualityControl(toga.App):
         'text': '#202124',          # Темно-серый текст
         'text_dim': '#5f6368',      # Приглушенный текст
         'input_bg': '#ffffff',      # Белый фон для полей ввода
+        'error': '#d32f2f',         # Красный для предупреждений
+    }
+
+    # Поля с подсказками: группа подсказок -> колонки БД, значения которых в нее входят
+    SUGGESTION_GROUPS = {
+        'casting': ['Наименование_отливки'],
+        'executor': ['Исполнитель1', 'Исполнитель2'],
+        'controller': ['Контролер1', 'Контролер2'],
     }
 
     def __init__(self):
@@ -22,7 +38,15 @@ class CastingQualityControl(toga.App):
             app_id='org.casting.quality.control',
             app_name='CastingQC'
         )
-        self.db = Database()
+        # БД открывается в фоновом потоке после показа окна (см. startup)
+        self.db = None
+        self.writer = None
+        self.spc = None
+        self.suggestions = {}
+        # Кэш числовых полей: "принято" пересчитывается по разнице одного поля
+        self.totals = FormTotals()
+        # Флаг программного изменения поля, чтобы не запускать проверку повторно
+        self.updating_field = False
 
     def create_labeled_input(self, label_text, input_widget, width=150):
         """Создает строку с меткой и полем ввода"""
@@ -31,9 +55,59 @@ class CastingQualityControl(toga.App):
         row.add(input_widget)
         return row
 
+    def create_suggestions(self, input_widget, group):
+        """Создает список подсказок для поля ввода по префиксному индексу группы"""
+        selection = toga.Selection(items=[''], style=Pack(width=180, padding=3))
+        updating = False
+
+        def on_input_change(widget):
+            nonlocal updating
+            # Поиск идет по индексу в памяти, без обращения к БД
+            # Индекс подставляется после загрузки из БД, до этого подсказок нет
+            index = self.suggestions.get(group)
+            updating = True
+            selection.items = [''] + (index.suggest(widget.value) if index else [])
+            updating = False
+
+        def on_select(widget):
+            if not updating and widget.value:
+                input_widget.value = widget.value
+
+        input_widget.on_change = on_input_change
+        selection.on_change = on_select
+        return selection
+
+    def load_data(self):
+        """Фоновый поток запуска: открывает БД и готовит справочник дефектов и подсказки"""
+        try:
+            db = Database()
+            STARTUP.mark('открытие БД и миграции')
+            defect_types = db.defect_types()
+            suggestions = {
+                group: PrefixIndex(db.recent_values(columns))
+                for group, columns in self.SUGGESTION_GROUPS.items()
+            }
+            STARTUP.mark('загрузка справочника и подсказок')
+            spc = SPCEngine.from_database(db)
+            STARTUP.mark('контрольные карты')
+        except Exception as e:
+            self.loop.call_soon_threadsafe(self.show_error_dialog, f'Не удалось открыть базу данных: {e}')
+            return
+        self.loop.call_soon_threadsafe(self.on_data_loaded, db, defect_types, suggestions, spc)
+
+    def on_data_loaded(self, db, defect_types, suggestions, spc):
+        # Выполняется в цикле событий, т.е. уже после завершения startup,
+        # поэтому finish_startup к этому моменту определен
+        self.finish_startup(db, defect_types, suggestions, spc)
+
     def startup(self):
+        STARTUP.mark('инициализация toga.App')
         # Создаем главное окно в самом начале метода
         self.main_window = toga.MainWindow(title='Контроль качества отливок')
+        self.on_exit = self.handle_exit
+
+        # Открытие БД не задерживает показ окна
+        threading.Thread(target=self.load_data, name='startup-db', daemon=True).start()
 
         # Обновляем стиль для секций
         section_style = Pack(
@@ -78,37 +152,45 @@ class CastingQualityControl(toga.App):
         left_column = toga.Box(style=Pack(direction=COLUMN, padding=5))
         
         # Определяем функцию обновления до её использования
-        def update_accepted_count(widget):
-            self.accepted_count.value = str(self.calculate_accepted())
-
-        def validate_positive_integer(widget):
-            """Проверяет и корректирует введенное значение"""
-            if widget.value:
-                # Оставляем только цифры и сразу обновляем значение
-                old_value = widget.value
-                new_value = ''.join(char for char in widget.value if char.isdigit())
-                
-                # Удаляем ведущие нули, если число не пустое
-                if new_value:
-                    new_value = str(int(new_value))
-                
-                # Если значение изменилось, обновляем поле
-                if new_value != old_value:
-                    widget.value = new_value
-            else:
-                widget.value = ''  # Оставляем поле пустым вместо '0'
-            
-            # Обновляем количество принятых
-            update_accepted_count(widget)
+        def update_accepted_count():
+            accepted = str(self.totals.accepted)
+            if self.accepted_count.value != accepted:
+                self.accepted_count.value = accepted
+
+        def create_validator(key):
+            """Обработчик числового поля: key - код дефекта или None для поля «Контроль подано»"""
+            def validate_positive_integer(widget):
+                """Проверяет и корректирует введенное значение"""
+                # Изменение, сделанное самим обработчиком, повторно не проверяем
+                if self.updating_field:
+                    return
+
+                # Оставляем только цифры без ведущих нулей; пустое поле остается пустым
+                new_value = clean_positive_integer(widget.value)
+                if new_value != (widget.value or ''):
+                    self.updating_field = True
+                    try:
+                        widget.value = new_value
+                    finally:
+                        self.updating_field = False
+
+                # Обновляем только изменившееся поле и количество принятых
+                if key is None:
+                    self.totals.set_submitted(int(new_value) if new_value else None)
+                else:
+                    self.totals.set_defect(key, int(new_value or 0))
+                update_accepted_count()
+
+            return METRICS.timed('ui_on_change_seconds')(validate_positive_integer)
 
         # Обновляем создание полей ввода для числовых значений
-        def create_input_with_update(placeholder):
+        def create_input_with_update(placeholder, key):
             input_field = toga.TextInput(
                 placeholder=placeholder,
                 style=input_style
             )
             # Добавляем обработчик изменений
-            input_field.on_change = validate_positive_integer
+            input_field.on_change = create_validator(key)
             return input_field
 
         # Основная информация
@@ -125,114 +207,41 @@ class CastingQualityControl(toga.App):
             placeholder='Введите количество',
             style=input_style
         )
-        self.submitted_count.on_change = validate_positive_integer
+        self.submitted_count.on_change = create_validator(None)
         self.acceptance_date = toga.DateInput(style=input_style)
         self.accepted_count = toga.TextInput(readonly=True, style=input_style)
         
-        basic_fields = [
-            ('Наименование отливки:', self.casting_name),
-            ('Исполнитель 1:', self.executor1),
-            ('Исполнитель 2:', self.executor2),
-            ('Контролер 1:', self.controller1),
-            ('Контролер 2:', self.controller2),
-            ('Контроль подано:', self.submitted_count),
-            ('Дата приемки:', self.acceptance_date),
-            ('Контроль принято:', self.accepted_count),
-        ]
+        basic_widgets = {
+            'Наименование_отливки': self.casting_name,
+            'Исполнитель1': self.executor1,
+            'Исполнитель2': self.executor2,
+            'Контролер1': self.controller1,
+            'Контролер2': self.controller2,
+            'Контроль_подано': self.submitted_count,
+            'Контроль_дата_приемки': self.acceptance_date,
+            'Контроль_принято': self.accepted_count,
+        }
+
+        # Подсказки по ранее введенным наименованиям и ФИО загружаются один раз при запуске
+        suggestion_widgets = {}
+        for group, columns in self.SUGGESTION_GROUPS.items():
+            for column in columns:
+                suggestion_widgets[column] = self.create_suggestions(basic_widgets[column], group)
         
         # Создаем строки для полей с новыми стилями
-        for label, field in basic_fields:
+        for column, label in BASIC_FIELDS:
             row = toga.Box(style=Pack(direction=ROW, padding=2))
             row.add(toga.Label(
                 label,
                 style=label_style
             ))
-            row.add(field)
+            row.add(basic_widgets[column])
+            if column in suggestion_widgets:
+                row.add(suggestion_widgets[column])
             basic_box.add(row)
         
         left_column.add(basic_box)
         
-        # Второй сорт и доработка в одной строке
-        defects_row = toga.Box(style=Pack(direction=ROW, padding=5))
-        
-        # Второй сорт
-        second_grade_box = toga.Box(style=section_style)
-        second_grade_box.add(toga.Label('ВТОРОЙ СОРТ', style=header_style))
-        
-        self.second_grade_fields = {}
-        second_grade_types = [
-            ('Раковины:', 'cavities'),
-            ('Зарез:', 'cut'),
-            ('Прочее:', 'other')
-        ]
-        
-        for label, key in second_grade_types:
-            input_field = create_input_with_update('Введите количество')
-            self.second_grade_fields[key] = {'input': input_field, 'label': label}
-            second_grade_box.add(self.create_labeled_input(label, input_field))
-        
-        defects_row.add(second_grade_box)
-        
-        # Доработка
-        rework_box = toga.Box(style=section_style)
-        rework_box.add(toga.Label('ДОРАБОТКА', style=header_style))
-        
-        self.rework_fields = {}
-        rework_types = [
-            ('Лапы:', 'paw'),
-            ('Питатель:', 'feeder'),
-            ('Корона:', 'crown')
-        ]
-        
-        for label, key in rework_types:
-            input_field = create_input_with_update('Введите количество')
-            self.rework_fields[key] = {'input': input_field, 'label': label}
-            rework_box.add(self.create_labeled_input(label, input_field))
-        
-        defects_row.add(rework_box)
-        left_column.add(defects_row)
-        
-        # Перемещаем окончательный брак в левую колонку
-        final_defect_box = toga.Box(style=section_style)
-        final_defect_box.add(toga.Label('ОКОНЧАТЕЛЬНЫЙ БРАК', style=header_style))
-
-        # Создаем сетку для окончательного брака (3 колонки)
-        self.final_defect_fields = {}
-        defect_types = [
-            # Первый столбец
-            ['Недолив', 'Вырыв', 'Зарез', 'Коробление', 'Наплыв металла', 'Нарушение геометрии', 'Нарушение маркировки'],
-            # Второй столбец
-            ['Непроклей', 'Неслитина', 'Несоответствие внешнего вида', 'Несоответствие размеров', 'Пеномодель', 'Пористость', 'Пригар песка'],
-            # Третий столбец
-            ['Рыхлота', 'Раковины', 'Скол', 'Слом', 'Спай', 'Трещины', 'Прочее']
-        ]
-
-        columns_box = toga.Box(style=Pack(direction=ROW))
-
-        for column_types in defect_types:
-            column_box = toga.Box(style=Pack(
-                direction=COLUMN,
-                padding=(0, 10),
-                width=250
-            ))
-            for defect_type in column_types:
-                input_field = create_input_with_update('Введите количество')
-                self.final_defect_fields[defect_type.lower()] = input_field
-                field_box = toga.Box(style=Pack(direction=COLUMN, padding=2))
-                field_box.add(toga.Label(
-                    defect_type + ':',
-                    style=Pack(
-                        padding=(0, 5),
-                        color=self.COLORS['text']
-                    )
-                ))
-                field_box.add(input_field)
-                column_box.add(field_box)
-            columns_box.add(column_box)
-
-        final_defect_box.add(columns_box)
-        left_column.add(final_defect_box)  # Добавляем в левую колонку
-
         # Примечание и кнопка сохранения в одной строке
         bottom_row = toga.Box(style=Pack(direction=ROW, padding=5))
 
@@ -246,10 +255,11 @@ class CastingQualityControl(toga.App):
         notes_box.add(self.notes)
         bottom_row.add(notes_box)
 
-        # Кнопка сохранения справа от примечания
+        # Кнопка сохранения справа от примечания; доступна после открытия БД
         save_button = toga.Button(
             'Сохранить',
             on_press=self.save_record,
+            enabled=False,
             style=Pack(
                 padding=(20, 20),
                 background_color=self.COLORS['primary'],
@@ -262,6 +272,10 @@ class CastingQualityControl(toga.App):
         # Добавляем строку с примечанием и кнопкой
         left_column.add(bottom_row)
 
+        # Сигналы контрольных карт по последним сохраненным записям (без модальных окон)
+        self.spc_label = toga.Label('', style=Pack(padding=(0, 10), color=self.COLORS['error']))
+        left_column.add(self.spc_label)
+
         # Удаляем правую колонку
         main_box.add(left_column)  # Добавляем только левую колонку
 
@@ -269,30 +283,99 @@ class CastingQualityControl(toga.App):
         self.main_window.content = main_box
         self.main_window.size = (900, 950)  # Увеличиваем высоту с 900 до 950
         self.main_window.show()
+        STARTUP.mark('основная информация и показ окна')
 
-    def calculate_accepted(self):
-        total_defects = 0
+        def build_defect_sections(catalog):
+            # Поля дефектов строятся по справочнику видов дефектов из БД
+            defect_types = {}
+            for code, category, label in catalog:
+                defect_types.setdefault(category, []).append((code, label))
+
+            # Второй сорт и доработка в одной строке
+            defects_row = toga.Box(style=Pack(direction=ROW, padding=5))
         
-        for field_data in self.second_grade_fields.values():
-            value = field_data['input'].value or '0'
-            total_defects += int(value if value.isdigit() else 0)
-            
-        for field_data in self.rework_fields.values():
-            value = field_data['input'].value or '0'
-            total_defects += int(value if value.isdigit() else 0)
-            
-        for field in self.final_defect_fields.values():
-            value = field.value or '0'
-            total_defects += int(value if value.isdigit() else 0)
-            
-        submitted = self.submitted_count.value or '0'
-        result = int(submitted if submitted.isdigit() else 0) - total_defects
-        return max(0, result)  # Возвращаем 0, если результат отрицательный
+            # Второй сорт
+            second_grade_box = toga.Box(style=section_style)
+            second_grade_box.add(toga.Label('ВТОРОЙ СОРТ', style=header_style))
+        
+            self.second_grade_fields = {}
+            for code, label in defect_types.get('second_grade', []):
+                input_field = create_input_with_update('Введите количество', code)
+                self.second_grade_fields[code] = {'input': input_field, 'label': label + ':'}
+                second_grade_box.add(self.create_labeled_input(label + ':', input_field))
+        
+            defects_row.add(second_grade_box)
+        
+            # Доработка
+            rework_box = toga.Box(style=section_style)
+            rework_box.add(toga.Label('ДОРАБОТКА', style=header_style))
+        
+            self.rework_fields = {}
+            for code, label in defect_types.get('rework', []):
+                input_field = create_input_with_update('Введите количество', code)
+                self.rework_fields[code] = {'input': input_field, 'label': label + ':'}
+                rework_box.add(self.create_labeled_input(label + ':', input_field))
+        
+            defects_row.add(rework_box)
+            left_column.insert(1, defects_row)
+        
+            # Перемещаем окончательный брак в левую колонку
+            final_defect_box = toga.Box(style=section_style)
+            final_defect_box.add(toga.Label('ОКОНЧАТЕЛЬНЫЙ БРАК', style=header_style))
+
+            # Создаем сетку для окончательного брака (3 колонки)
+            self.final_defect_fields = {}
+            final_types = defect_types.get('final', [])
+            column_size = max(1, -(-len(final_types) // 3))
+
+            columns_box = toga.Box(style=Pack(direction=ROW))
+
+            for start in range(0, len(final_types), column_size):
+                column_box = toga.Box(style=Pack(
+                    direction=COLUMN,
+                    padding=(0, 10),
+                    width=250
+                ))
+                for code, defect_type in final_types[start:start + column_size]:
+                    input_field = create_input_with_update('Введите количество', code)
+                    self.final_defect_fields[code] = input_field
+                    field_box = toga.Box(style=Pack(direction=COLUMN, padding=2))
+                    field_box.add(toga.Label(
+                        defect_type + ':',
+                        style=Pack(
+                            padding=(0, 5),
+                            color=self.COLORS['text']
+                        )
+                    ))
+                    field_box.add(input_field)
+                    column_box.add(field_box)
+                columns_box.add(column_box)
+
+            final_defect_box.add(columns_box)
+            left_column.insert(2, final_defect_box)  # Добавляем в левую колонку после второго сорта
+
+        def finish_startup(db, catalog, suggestions, spc):
+            # Второй этап запуска в цикле событий, когда БД уже открыта в фоне
+            self.db = db
+            self.spc = spc
+            self.suggestions.update(suggestions)
+            build_defect_sections(catalog)
+            # Сохранение идет в фоновом потоке пачками, чтобы не блокировать интерфейс
+            self.writer = BackgroundWriter(self.db, on_error=self.on_write_error, on_saved=self.on_records_saved)
+            save_button.enabled = True
+            STARTUP.mark('секции дефектов')
+            STARTUP.report()
+
+        self.finish_startup = finish_startup
+
+    def calculate_accepted(self):
+        # Сумма дефектов поддерживается обработчиками полей, поля заново не читаются
+        return self.totals.accepted
 
     def show_success_dialog(self):
         self.main_window.info_dialog(
             'Успех',
-            'Запись успешно сохранена'
+            'Запись поставлена в очередь на сохранение'
         )
 
     def show_error_dialog(self, message):
@@ -301,39 +384,90 @@ class CastingQualityControl(toga.App):
             message
         )
 
+    def on_write_error(self, row, error):
+        # Вызывается из потока записи - передаем диалог в цикл событий интерфейса
+        message = f'Не удалось сохранить запись «{row["Наименование_отливки"]}»: {error}'
+        self.loop.call_soon_threadsafe(self.show_error_dialog, message)
+
+    def on_records_saved(self, rows):
+        # Вызывается из потока записи: проверка по контрольным картам идет там же,
+        # в интерфейс передается только текст сигнала
+        names = dict(DEFECT_CATEGORIES)
+        messages = []
+        for row in rows:
+            try:
+                signals = self.spc.observe(row)
+            except Exception as e:
+                # Запись уже сохранена; сбой проверки не должен мешать потоку записи
+                messages.append(f'«{row.get("Наименование_отливки")}»: не удалось проверить по контрольным картам ({e})')
+                continue
+            for signal in signals:
+                category = names.get(signal.category, 'все дефекты')
+                bound = 'выше' if signal.value > signal.ucl else 'ниже'
+                limit = signal.ucl if signal.value > signal.ucl else signal.lcl
+                messages.append(
+                    f'«{signal.casting}»: {category} {signal.value:.1%} - {bound} границы {limit:.1%} '
+                    f'(среднее {signal.center:.1%})'
+                )
+        if messages:
+            self.loop.call_soon_threadsafe(self.show_spc_signals, messages)
+
+    def show_spc_signals(self, messages):
+        self.spc_label.text = 'Выход за контрольные границы: ' + '; '.join(messages)
+
+    def handle_exit(self, app, **kwargs):
+        # Дописываем все накопленные записи и закрываем соединения перед закрытием приложения
+        if self.writer:
+            self.writer.close()
+        if self.db:
+            self.db.close()
+        METRICS.dump()
+        return True
+
+    @METRICS.timed('ui_save_record_seconds')
     def save_record(self, widget):
         try:
             # Проверяем обязательные поля
             if not self.casting_name.value:
                 raise ValueError("Необходимо указать наименование отливки")
             
-            if not self.submitted_count.value or not self.submitted_count.value.isdigit():
+            if self.totals.submitted is None:
                 raise ValueError("Необходимо указать корректное количество поданных на контроль")
                 
             if not self.acceptance_date.value:
                 raise ValueError("Необходимо указать дату приемки")
 
             accepted_count = self.calculate_accepted()
-            date_str = self.acceptance_date.value.strftime('%d.%m.%Y') if self.acceptance_date.value else ''
+            # Дата хранится в ISO-формате (гггг-мм-дд), чтобы сортировка и индексы работали по дате
+            date_str = self.acceptance_date.value.isoformat() if self.acceptance_date.value else ''
             
-            # Создаем кортеж данных
-            data = (
-                self.casting_name.value,
-                self.executor1.value,
-                self.executor2.value,
-                self.controller1.value,
-                self.controller2.value,
-                int(self.submitted_count.value or 0),
-                date_str,
-                accepted_count,
-                *(int(field_data['input'].value or 0) for field_data in self.second_grade_fields.values()),
-                *(int(field_data['input'].value or 0) for field_data in self.rework_fields.values()),
-                *(int(field.value or 0) for field in self.final_defect_fields.values()),
-                self.notes.value
-            )
+            # Дефекты берутся из кэша полей по кодам справочника, нулевые в БД не пишутся
+            defects = {code: qty for code, qty in self.totals.defects.items() if qty}
+
+            # Создаем запись
+            data = {
+                'Наименование_отливки': self.casting_name.value,
+                'Исполнитель1': self.executor1.value,
+                'Исполнитель2': self.executor2.value,
+                'Контролер1': self.controller1.value,
+                'Контролер2': self.controller2.value,
+                'Контроль_подано': self.totals.submitted,
+                'Контроль_дата_приемки': date_str,
+                'Контроль_принято': accepted_count,
+                'Примечание': self.notes.value,
+                'defects': defects,
+            }
             
-            self.db.insert_record(data)
-            self.show_success_dialog()
+            self.writer.submit(data)
+
+            # Новые значения сразу попадают в подсказки
+            for group, columns in self.SUGGESTION_GROUPS.items():
+                for column in columns:
+                    self.suggestions[group].add(data[column])
+
+            # Диалог замеряется отдельно от сохранения
+            with METRICS.timer('ui_dialog_seconds'):
+                self.show_success_dialog()
                 
         except ValueError as ve:
             self.show_error_dialog(str(ve))
@@ -0,0 +1,56 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+
+class PrefixIndex:
+    """Префиксный поиск по ранее введенным значениям.
+
+    Ключи хранятся в отсортированном списке, поэтому поиск - это бинарный поиск
+    плюс проход по совпадающему диапазону. Размер ограничен max_size: при переполнении
+    вытесняется значение, которое дольше всех не использовалось (LRU).
+    """
+
+    def __init__(self, values=(), max_size=50000):
+        self.max_size = max_size
+        self.keys = []
+        # ключ -> исходное написание; порядок словаря - от давно использованных к недавним
+        self.values = OrderedDict()
+        for value in values:
+            self.add(value)
+
+    @staticmethod
+    def normalize(value):
+        return ' '.join(value.split()).casefold()
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        """Добавляет значение или отмечает его как недавно использованное"""
+        if not value or not value.strip():
+            return
+        value = ' '.join(value.split())
+        key = value.casefold()
+        if key in self.values:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            return
+
+        insort(self.keys, key)
+        self.values[key] = value
+        if len(self.values) > self.max_size:
+            oldest, _ = self.values.popitem(last=False)
+            del self.keys[bisect_left(self.keys, oldest)]
+
+    def suggest(self, prefix, limit=10):
+        """До limit значений, начинающихся с prefix (без учета регистра), в алфавитном порядке"""
+        prefix = self.normalize(prefix or '')
+        if not prefix:
+            return []
+        result = []
+        for i in range(bisect_left(self.keys, prefix), len(self.keys)):
+            key = self.keys[i]
+            if not key.startswith(prefix) or len(result) >= limit:
+                break
+            result.append(self.values[key])
+        return result
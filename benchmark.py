@@ -0,0 +1,234 @@
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from database import Database
+from fields import DEFAULT_DEFECT_TYPES
+from form_model import FormTotals, clean_positive_integer
+
+# Синтетические данные: доля записей с дефектом данного вида и среднее количество.
+# Несколько видов брака встречаются часто, остальные редко - как в реальной статистике.
+DEFECT_RATES = {
+    code: (0.25, 3.0) if i % 9 == 0 else (0.06, 1.5) if i % 4 == 0 else (0.015, 1.0)
+    for i, (code, _, _) in enumerate(DEFAULT_DEFECT_TYPES)
+}
+
+
+def generate_records(count, seed=0, days=5 * 365, castings=300, people=40):
+    """Генератор правдоподобных записей осмотра (словари в формате Database.insert_record)
+
+    Даты приемки равномерно распределены по последним days дням.
+    """
+    rng = random.Random(seed)
+    start = date.today() - timedelta(days=days - 1)
+    casting_names = [f'Отливка {i:04d}' for i in range(castings)]
+    # Распределение Ципфа: небольшая часть номенклатуры дает основную часть записей
+    casting_weights = [1 / (i + 1) for i in range(castings)]
+    executors = [f'Исполнитель {i:02d}' for i in range(people)]
+    controllers = [f'Контролер {i:02d}' for i in range(people // 4 or 1)]
+
+    for _ in range(count):
+        submitted = max(1, int(rng.lognormvariate(4, 0.8)))
+        defects = {}
+        for code, (probability, mean) in DEFECT_RATES.items():
+            if rng.random() < probability:
+                defects[code] = min(submitted, 1 + int(rng.expovariate(1 / mean)))
+        yield {
+            'Наименование_отливки': rng.choices(casting_names, casting_weights)[0],
+            'Исполнитель1': rng.choice(executors),
+            'Исполнитель2': rng.choice(executors) if rng.random() < 0.3 else '',
+            'Контролер1': rng.choice(controllers),
+            'Контролер2': rng.choice(controllers) if rng.random() < 0.2 else '',
+            'Контроль_подано': submitted,
+            'Контроль_дата_приемки': (start + timedelta(days=rng.randrange(days))).isoformat(),
+            'Контроль_принято': max(0, submitted - sum(defects.values())),
+            'Примечание': '',
+            'defects': defects,
+        }
+
+
+def populate(db, count, batch_size=5000, seed=0):
+    batch = []
+    for record in generate_records(count, seed=seed):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            db.insert_many(batch)
+            batch = []
+    if batch:
+        db.insert_many(batch)
+
+
+def measure(function, repeat=5, ops=1):
+    """Запускает function repeat раз; ops - число операций за один запуск"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    return {
+        'repeat': repeat,
+        'ops': ops,
+        'min_s': best,
+        'median_s': statistics.median(timings),
+        'ops_per_s': ops / best if best > 0 else None,
+    }
+
+
+def bench_inserts(workdir, single=500, batched=20000, batch_size=500):
+    results = {}
+    records = list(generate_records(max(single, batched), seed=1))
+
+    db = Database(os.path.join(workdir, 'insert_single.db'))
+    it = iter(records)
+    results['insert_record'] = measure(lambda: [db.insert_record(next(it)) for _ in range(single // 5)],
+                                       repeat=5, ops=single // 5)
+    db.close()
+
+    db = Database(os.path.join(workdir, 'insert_many.db'))
+    chunks = [records[i:i + batch_size] for i in range(0, batched, batch_size)]
+
+    def insert_batches():
+        for chunk in chunks:
+            db.insert_many(chunk)
+
+    results[f'insert_many_batch_{batch_size}'] = measure(insert_batches, repeat=3, ops=batched)
+    db.close()
+    return results
+
+
+def bench_cold_start(workdir, large_path):
+    results = {}
+    counter = iter(range(10 ** 6))
+
+    def open_empty():
+        Database(os.path.join(workdir, f'empty_{next(counter)}.db')).close()
+
+    results['create_table_empty'] = measure(open_empty, repeat=5)
+    results['create_table_populated'] = measure(lambda: Database(large_path).close(), repeat=5)
+    return results
+
+
+def bench_queries(large_path):
+    results = {}
+    db = Database(large_path)
+    conn = db.get_read_connection()
+    # Месяц примерно годичной давности и год до него
+    month_start = (date.today() - timedelta(days=365)).replace(day=1)
+    month_from = month_start.isoformat()
+    month_to = (month_start + timedelta(days=30)).isoformat()
+    year_from = (month_start - timedelta(days=365)).isoformat()
+    casting = 'Отливка 0007'
+
+    results['iter_records_month'] = measure(lambda: sum(1 for _ in db.iter_records(month_from, month_to)))
+    results['defect_summary_month'] = measure(lambda: db.defect_summary(month_from, month_to))
+    results['defect_summary_year_by_month'] = measure(
+        lambda: db.defect_summary(year_from, month_from, period='month'))
+    results['defect_pareto_90_days'] = measure(lambda: db.defect_pareto(90))
+    results['defect_pareto_casting'] = measure(lambda: db.defect_pareto(3650, casting=casting))
+    # Та же агрегация по одной отливке напрямую по сырым таблицам - для сравнения со сводками
+    results['raw_casting_defects'] = measure(lambda: conn.execute('''
+        SELECT d.defect_code, SUM(d.qty)
+        FROM inspections AS i JOIN inspection_defects AS d ON d.inspection_id = i.ID
+        WHERE i.Наименование_отливки = ?
+        GROUP BY d.defect_code
+    ''', (casting,)).fetchall())
+    results['raw_date_range_count'] = measure(lambda: conn.execute(
+        'SELECT COUNT(*), SUM(Контроль_подано) FROM inspections WHERE Контроль_дата_приемки BETWEEN ? AND ?',
+        (month_from, month_to)).fetchone())
+    db.close()
+    return results
+
+
+def bench_accepted(keystrokes=20000, seed=2):
+    """Пересчет "Контроль принято" на потоке нажатий по 28 числовым полям формы"""
+    rng = random.Random(seed)
+    keys = [code for code, _, _ in DEFAULT_DEFECT_TYPES]
+    events = [(rng.choice(keys + [None]), str(rng.randrange(0, 50))) for _ in range(keystrokes)]
+
+    def full_recompute():
+        # Прежний способ: после каждого нажатия перечитываются и разбираются все поля
+        texts = dict.fromkeys(keys, '')
+        submitted = ''
+        for key, text in events:
+            text = clean_positive_integer(text)
+            if key is None:
+                submitted = text
+            else:
+                texts[key] = text
+            total = sum(int(value or 0) for value in texts.values())
+            max(0, int(submitted or 0) - total)
+
+    def incremental():
+        totals = FormTotals()
+        for key, text in events:
+            text = clean_positive_integer(text)
+            if key is None:
+                totals.set_submitted(int(text) if text else None)
+            else:
+                totals.set_defect(key, int(text or 0))
+            totals.accepted
+
+    return {
+        'accepted_full_recompute': measure(full_recompute, ops=keystrokes),
+        'accepted_incremental': measure(incremental, ops=keystrokes),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(rows=100000, keep=None):
+    """Запускает все замеры; rows - объем БД для холодного старта и запросов.
+
+    keep - путь для сохранения заполненной БД между запусками (повторно не заполняется).
+    """
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'rows': rows,
+        },
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        large_path = keep or os.path.join(workdir, 'large.db')
+        if not os.path.exists(large_path):
+            started = time.perf_counter()
+            db = Database(large_path)
+            populate(db, rows)
+            db.close()
+            results['meta']['populate_s'] = time.perf_counter() - started
+
+        results['results'].update(bench_inserts(workdir))
+        results['results'].update(bench_cold_start(workdir, large_path))
+        results['results'].update(bench_queries(large_path))
+        results['results'].update(bench_accepted())
+    return results
+
+
+def write_results(results, path=None):
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,207 @@
+import argparse
+from datetime import datetime
+
+from database import Database
+from metrics import METRICS
+
+
+def parse_date(value):
+    """Дата из командной строки: 'гггг-мм-дд' или 'дд.мм.гггг' -> ISO-строка"""
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f'Некорректная дата: {value}')
+
+
+def rebuild_rollups(args):
+    db = Database(args.db)
+    db.rebuild_rollups()
+    print('Сводные таблицы пересчитаны')
+
+
+def pareto(args):
+    db = Database(args.db)
+    rows = db.defect_pareto(args.days, casting=args.casting, controller=args.controller)
+    for metric, qty, share, cumulative in rows:
+        print(f'{metric:<50} {qty:>8} {share:>7.1%} {cumulative:>7.1%}')
+
+
+def export(args):
+    from export import export_records, report
+
+    output = args.output or f'castings_{args.date_from or "all"}_{args.date_to or "all"}.{args.format}'
+    db = Database(args.db)
+    count, elapsed = export_records(db, output, args.format, args.date_from, args.date_to)
+    report(count, elapsed)
+    print(output)
+
+
+def bench(args):
+    from benchmark import run, write_results
+
+    write_results(run(rows=args.rows, keep=args.keep), args.output)
+
+
+def sync(args):
+    from sync import sync_files
+
+    scanned, merged, elapsed = sync_files(args.db, args.central, args.batch_size)
+    print(f'Прочитано из журнала: {scanned}, добавлено в центральную БД: {merged} за {elapsed:.2f} с')
+
+
+def new_terminal_id(args):
+    db = Database(args.db)
+    print(f'Новый идентификатор терминала: {db.new_terminal_id()}')
+
+
+def search(args):
+    db = Database(args.db)
+    for record_id, casting, accepted_on, _, fragment, _ in db.search(args.query, args.limit, raw=args.raw):
+        print(f'{record_id:>8}  {accepted_on or "":<10}  {casting or "":<30}  {fragment}')
+
+
+def import_(args):
+    import sys
+    from importer import import_files
+
+    def progress(read, imported, rejected, elapsed):
+        rate = imported / elapsed if elapsed > 0 else 0
+        print(f'\rПрочитано: {read}, импортировано: {imported}, отклонено: {rejected} ({rate:.0f} записей/с)',
+              end='', file=sys.stderr, flush=True)
+
+    db = Database(args.db)
+    imported, rejected, elapsed = import_files(
+        db, args.files, args.rejects, workers=args.workers, progress=progress
+    )
+    print(file=sys.stderr)
+    print(f'Импортировано записей: {imported} за {elapsed:.2f} с, отклонено: {rejected}')
+    if rejected:
+        print(f'Отклоненные строки: {args.rejects}')
+
+
+def spc(args):
+    from spc import recompute
+
+    db = Database(args.db)
+    for chart in recompute(db, args.date_from, args.sigma):
+        if chart['out_of_control']:
+            print(f"{chart['casting']:<30} {chart['category']:<12} {chart['chart']}-карта "
+                  f"центр {chart['center']:.4f}, вне границ {len(chart['out_of_control'])} из {chart['points']}")
+
+
+def maintain(args):
+    import sys
+    from maintenance import maintain as run_maintenance
+
+    def progress(year, moved):
+        print(f'\rПеренесено в архив: {moved} (год {year})', end='', file=sys.stderr, flush=True)
+
+    db = Database(args.db)
+    moved, held, freed, size_before, size_after, elapsed = run_maintenance(
+        db, args.keep_days, args.batch_size, progress, args.force
+    )
+    if moved:
+        print(file=sys.stderr)
+    print(f'Перенесено в архив: {moved}, освобождено страниц: {freed}')
+    if held:
+        print(f'Не перенесено записей терминала, еще не переданных в центральную БД: {held} '
+              f'(выполните sync --central ... или укажите --force)')
+    print(f'Размер БД: {size_before / 2 ** 20:.1f} -> {size_after / 2 ** 20:.1f} МБ '
+          f'(освобождено {(size_before - size_after) / 2 ** 20:.1f} МБ) за {elapsed:.2f} с')
+
+
+def serve(args):
+    from server import run
+
+    print(f'Сервис отчетов: http://{args.host}:{args.port}/api', flush=True)
+    run(args.db, args.host, args.port, args.workers, args.ttl, args.streams)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='castingqc', description='Служебные команды контроля качества отливок')
+    parser.add_argument('--db', default='castings.db', help='Путь к файлу базы данных')
+    parser.add_argument('--metrics', help='Записать метрики в файл (.prom - формат Prometheus, иначе JSON)')
+    parser.add_argument('--trace-sql', nargs='?', const='1',
+                        help='Трассировка SQL-запросов в stderr или в указанный файл')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('rebuild-rollups', help='Пересчитать сводные таблицы дефектов')
+    command.set_defaults(handler=rebuild_rollups)
+
+    command = commands.add_parser('pareto', help='Парето дефектов за последние N дней')
+    command.add_argument('--days', type=int, default=30)
+    only = command.add_mutually_exclusive_group()
+    only.add_argument('--casting', help='Только указанная отливка')
+    only.add_argument('--controller', help='Только указанный контролер')
+    command.set_defaults(handler=pareto)
+
+    command = commands.add_parser('export', help='Выгрузить записи в CSV/XLSX')
+    command.add_argument('--from', dest='date_from', type=parse_date, help='Начальная дата приемки')
+    command.add_argument('--to', dest='date_to', type=parse_date, help='Конечная дата приемки')
+    command.add_argument('--format', choices=['csv', 'xlsx'], default='csv')
+    command.add_argument('--output', help='Файл выгрузки (по умолчанию castings_<from>_<to>.<format>)')
+    command.set_defaults(handler=export)
+
+    command = commands.add_parser('import', help='Импорт старых таблиц осмотров из CSV/XLSX')
+    command.add_argument('files', nargs='+')
+    command.add_argument('--rejects', default='import_rejects.csv', help='Файл для отклоненных строк')
+    command.add_argument('--workers', type=int, help='Число процессов проверки (по умолчанию - число ядер)')
+    command.set_defaults(handler=import_)
+
+    command = commands.add_parser('sync', help='Перенести новые записи этого терминала в центральную БД')
+    command.add_argument('--central', required=True, help='Путь к центральной базе данных')
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(handler=sync)
+
+    command = commands.add_parser('new-terminal-id',
+                                  help='Назначить новый идентификатор терминала (файл скопирован с другого)')
+    command.set_defaults(handler=new_terminal_id)
+
+    command = commands.add_parser('search', help='Полнотекстовый поиск по примечаниям, наименованиям и ФИО')
+    command.add_argument('query')
+    command.add_argument('--limit', type=int, default=50)
+    command.add_argument('--raw', action='store_true', help='Запрос в синтаксисе FTS5 как есть')
+    command.set_defaults(handler=search)
+
+    command = commands.add_parser('spc', help='Пересчитать контрольные карты по всем отливкам')
+    command.add_argument('--from', dest='date_from', type=parse_date, help='Начальная дата приемки')
+    command.add_argument('--sigma', type=float, default=3.0)
+    command.set_defaults(handler=spc)
+
+    command = commands.add_parser('maintain', help='Архивировать старые записи и сжать БД')
+    command.add_argument('--keep-days', type=int, default=3 * 365,
+                         help='Записи старше стольких дней переносятся в архивы по годам')
+    command.add_argument('--batch-size', type=int, default=5000)
+    command.add_argument('--force', action='store_true',
+                         help='На терминале архивировать и записи, еще не переданные в центральную БД')
+    command.set_defaults(handler=maintain)
+
+    command = commands.add_parser('serve', help='HTTP/JSON-сервис отчетов только для чтения')
+    command.add_argument('--host', default='127.0.0.1')
+    command.add_argument('--port', type=int, default=8080)
+    command.add_argument('--workers', type=int, default=8, help='Потоков для запросов к БД')
+    command.add_argument('--ttl', type=float, default=30.0, help='Время жизни кэша ответов, с')
+    command.add_argument('--streams', type=int, default=4, help='Одновременных потоковых выгрузок /api/records')
+    command.set_defaults(handler=serve)
+
+    command = commands.add_parser('bench', help='Замеры производительности БД и расчетов формы (JSON)')
+    command.add_argument('--rows', type=int, default=100000, help='Объем тестовой БД (например, 1000000)')
+    command.add_argument('--keep', help='Сохранить заполненную тестовую БД в этот файл и использовать повторно')
+    command.add_argument('--output', help='Файл для результатов (по умолчанию вывод в консоль)')
+    command.set_defaults(handler=bench)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.metrics:
+        METRICS.enable(args.metrics)
+    if args.trace_sql:
+        METRICS.trace_sql = args.trace_sql
+    try:
+        return args.handler(args)
+    finally:
+        METRICS.dump()
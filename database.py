@@ -1,83 +1,1003 @@
+import re
 import sqlite3
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from pathlib import Path
 import threading
+import uuid
+
+from fields import BASIC_FIELDS, NOTES_COLUMN, DEFECT_CATEGORIES, DEFAULT_DEFECT_TYPES
+from metrics import METRICS
+
+# Колонки заголовка осмотра (таблица inspections, без ID) в порядке вставки
+HEADER_COLUMNS = [column for column, _ in BASIC_FIELDS] + [NOTES_COLUMN]
+# Колонки дефектов исходной широкой таблицы castings (нужны только миграциям)
+LEGACY_DEFECT_COLUMNS = [code for code, _, _ in DEFAULT_DEFECT_TYPES]
+
+# Сводные таблицы: (таблица, колонка ключа, исходная колонка заголовка).
+# Хранятся в "длинном" виде: одна строка на (ключ, день, показатель);
+# показатель - это либо один из HEADER_METRICS, либо код вида дефекта.
+ROLLUPS = [
+    ('rollup_casting_day', 'casting', 'Наименование_отливки'),
+    ('rollup_controller_day', 'controller', 'Контролер1'),
+]
+# Показатели заголовка: (имя показателя, исходная колонка; None - счетчик записей)
+HEADER_METRICS = [
+    ('inspections', None),
+    ('submitted', 'Контроль_подано'),
+    ('accepted', 'Контроль_принято'),
+]
+
+# Текстовые поля осмотра, по которым работает полнотекстовый поиск
+SEARCH_COLUMNS = [
+    'Наименование_отливки', 'Исполнитель1', 'Исполнитель2', 'Контролер1', 'Контролер2', NOTES_COLUMN,
+]
+
+# Построчные триггеры вставки, которые для пачек от BULK_INSERT_MIN записей
+# заменяются пакетными запросами (_apply_bulk_triggers)
+BULK_TRIGGERS = [
+    *(f'inspections_{table}_ai' for table, _, _ in ROLLUPS),
+    *(f'inspection_defects_{table}_ai' for table, _, _ in ROLLUPS),
+    'inspections_journal_ai',
+    'inspections_fts_ai',
+]
+BULK_INSERT_MIN = 500
+
+# Справочник видов дефектов в порядке секций и полей формы
+DEFECT_TYPES_QUERY = '''
+SELECT code, category, label FROM defect_types
+ORDER BY CASE category {} END, position
+'''.format(' '.join(f"WHEN '{category}' THEN {i}" for i, (category, _) in enumerate(DEFECT_CATEGORIES)))
+
+
+def _migrate_iso_dates(conn):
+    # Дата приемки хранилась как 'дд.мм.гггг' - переводим в ISO 'гггг-мм-дд',
+    # чтобы строковый порядок совпадал с хронологическим и работали индексы
+    conn.execute('''
+    UPDATE castings
+    SET Контроль_дата_приемки = substr(Контроль_дата_приемки, 7, 4) || '-' ||
+                                substr(Контроль_дата_приемки, 4, 2) || '-' ||
+                                substr(Контроль_дата_приемки, 1, 2)
+    WHERE Контроль_дата_приемки GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]'
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_castings_date ON castings (Контроль_дата_приемки)')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_castings_name_date
+    ON castings (Наименование_отливки, Контроль_дата_приемки)
+    ''')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_castings_controller_date
+    ON castings (Контролер1, Контроль_дата_приемки)
+    ''')
+
+
+def _migrate_rollups(conn):
+    # Сводки по дням поддерживаются триггером при каждой вставке,
+    # поэтому отчеты не сканируют всю историю castings
+    for table, key, source in ROLLUPS:
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            {key} TEXT NOT NULL,
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            PRIMARY KEY ({key}, day, metric)
+        ) WITHOUT ROWID
+        ''')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_day ON {table} (day, metric)')
+
+        metrics = HEADER_METRICS + [(column, column) for column in LEGACY_DEFECT_COLUMNS]
+        values = ' UNION ALL '.join(
+            f"SELECT '{metric}' AS metric, {'NEW.' + column if column else 1} AS qty"
+            for metric, column in metrics
+        )
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS castings_{table}_ai AFTER INSERT ON castings
+        BEGIN
+            INSERT INTO {table} ({key}, day, metric, qty)
+            SELECT coalesce(NEW.{source}, ''), coalesce(NEW.Контроль_дата_приемки, ''), metric, qty
+            FROM ({values})
+            WHERE qty > 0
+            ON CONFLICT ({key}, day, metric) DO UPDATE SET qty = qty + excluded.qty;
+        END
+        ''')
+
+        # Заполняем сводку по уже существующим записям
+        parts = [
+            f"SELECT coalesce({source}, '') AS key, coalesce(Контроль_дата_приемки, '') AS day, "
+            f"'{metric}' AS metric, {column or 1} AS qty FROM castings"
+            for metric, column in metrics
+        ]
+        conn.execute(f'''
+        INSERT INTO {table} ({key}, day, metric, qty)
+        SELECT key, day, metric, SUM(qty) FROM ({' UNION ALL '.join(parts)})
+        WHERE qty > 0
+        GROUP BY key, day, metric
+        ''')
+
+
+def _create_castings_view(conn):
+    # Широкое представление castings (одна колонка на вид дефекта) для совместимости
+    # со старыми запросами; колонки строятся по справочнику defect_types
+    codes = [code for code, _, _ in conn.execute(DEFECT_TYPES_QUERY)]
+    defect_columns = ''.join(
+        f''',
+            coalesce((SELECT qty FROM inspection_defects AS d
+                      WHERE d.inspection_id = i.ID AND d.defect_code = '{code}'), 0) AS "{code}"'''
+        for code in codes
+    )
+    basic_columns = ', '.join(f'i.{column}' for column, _ in BASIC_FIELDS)
+    conn.execute('DROP VIEW IF EXISTS castings')
+    conn.execute(f'''
+    CREATE VIEW castings AS
+    SELECT i.ID, {basic_columns}{defect_columns},
+           i.{NOTES_COLUMN}
+    FROM inspections AS i
+    ''')
+
+
+def _create_rollup_triggers(conn):
+    for table, key, source in ROLLUPS:
+        values = ' UNION ALL '.join(
+            f"SELECT '{metric}' AS metric, {'NEW.' + column if column else 1} AS qty"
+            for metric, column in HEADER_METRICS
+        )
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS inspections_{table}_ai AFTER INSERT ON inspections
+        BEGIN
+            INSERT INTO {table} ({key}, day, metric, qty)
+            SELECT coalesce(NEW.{source}, ''), coalesce(NEW.Контроль_дата_приемки, ''), metric, qty
+            FROM ({values})
+            WHERE qty > 0
+            ON CONFLICT ({key}, day, metric) DO UPDATE SET qty = qty + excluded.qty;
+        END
+        ''')
+        # Дефекты вставляются после заголовка, поэтому ключ и день берем из inspections
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS inspection_defects_{table}_ai AFTER INSERT ON inspection_defects
+        BEGIN
+            INSERT INTO {table} ({key}, day, metric, qty)
+            SELECT coalesce(i.{source}, ''), coalesce(i.Контроль_дата_приемки, ''), NEW.defect_code, NEW.qty
+            FROM inspections AS i
+            WHERE i.ID = NEW.inspection_id
+            ON CONFLICT ({key}, day, metric) DO UPDATE SET qty = qty + excluded.qty;
+        END
+        ''')
+
+
+def _rebuild_rollups(conn, inspections='inspections', defects='inspection_defects'):
+    # Полный пересчет сводок по заголовкам и дефектам (вызывается внутри транзакции);
+    # вместо таблиц можно передать представления вместе с архивами
+    for table, key, source in ROLLUPS:
+        parts = [
+            f"SELECT coalesce({source}, '') AS key, coalesce(Контроль_дата_приемки, '') AS day, "
+            f"'{metric}' AS metric, {column or 1} AS qty FROM {inspections}"
+            for metric, column in HEADER_METRICS
+        ]
+        parts.append(
+            f"SELECT coalesce(i.{source}, ''), coalesce(i.Контроль_дата_приемки, ''), d.defect_code, d.qty "
+            f"FROM {defects} AS d JOIN {inspections} AS i ON i.ID = d.inspection_id"
+        )
+        conn.execute(f'DELETE FROM {table}')
+        conn.execute(f'''
+        INSERT INTO {table} ({key}, day, metric, qty)
+        SELECT key, day, metric, SUM(qty) FROM ({' UNION ALL '.join(parts)})
+        WHERE qty > 0
+        GROUP BY key, day, metric
+        ''')
+
+
+def _migrate_normalized(conn):
+    # Широкая строка castings (27 колонок дефектов, почти всегда нулевых) заменяется
+    # заголовком осмотра и строками (осмотр, вид дефекта, количество) только для ненулевых
+    # значений. Виды дефектов берутся из справочника, castings остается представлением.
+    conn.execute('''
+    CREATE TABLE defect_types (
+        code TEXT PRIMARY KEY,
+        category TEXT NOT NULL,
+        label TEXT NOT NULL,
+        position INTEGER NOT NULL
+    )
+    ''')
+    conn.executemany(
+        'INSERT INTO defect_types (code, category, label, position) VALUES (?, ?, ?, ?)',
+        [(code, category, label, position) for position, (code, category, label) in enumerate(DEFAULT_DEFECT_TYPES)]
+    )
+
+    conn.execute('''
+    CREATE TABLE inspections (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Наименование_отливки TEXT,
+        Исполнитель1 TEXT,
+        Исполнитель2 TEXT,
+        Контролер1 TEXT,
+        Контролер2 TEXT,
+        Контроль_подано INTEGER,
+        Контроль_дата_приемки DATE,
+        Контроль_принято INTEGER,
+        Примечание TEXT
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE inspection_defects (
+        inspection_id INTEGER NOT NULL REFERENCES inspections (ID),
+        defect_code TEXT NOT NULL REFERENCES defect_types (code),
+        qty INTEGER NOT NULL CHECK (qty > 0),
+        PRIMARY KEY (inspection_id, defect_code)
+    ) WITHOUT ROWID
+    ''')
+
+    # Переносим данные: заголовки с прежними ID и только ненулевые дефекты
+    header = ', '.join(HEADER_COLUMNS)
+    conn.execute(f'INSERT INTO inspections (ID, {header}) SELECT ID, {header} FROM castings')
+    for column in LEGACY_DEFECT_COLUMNS:
+        conn.execute(f'''
+        INSERT INTO inspection_defects (inspection_id, defect_code, qty)
+        SELECT ID, '{column}', {column} FROM castings WHERE {column} > 0
+        ''')
+    # Вместе с таблицей удаляются ее индексы и триггеры сводок
+    conn.execute('DROP TABLE castings')
+
+    conn.execute('CREATE INDEX idx_inspections_date ON inspections (Контроль_дата_приемки)')
+    conn.execute('''
+    CREATE INDEX idx_inspections_name_date
+    ON inspections (Наименование_отливки, Контроль_дата_приемки)
+    ''')
+    conn.execute('''
+    CREATE INDEX idx_inspections_controller_date
+    ON inspections (Контролер1, Контроль_дата_приемки)
+    ''')
+    conn.execute('CREATE INDEX idx_inspection_defects_code ON inspection_defects (defect_code, inspection_id)')
+
+    _create_rollup_triggers(conn)
+    _rebuild_rollups(conn)
+    _create_castings_view(conn)
+
+
+def _migrate_journal(conn):
+    # Для объединения данных нескольких терминалов: у каждой БД свой идентификатор терминала,
+    # у каждой записи - глобально уникальный uid, а журнал изменений только дополняется
+    conn.execute('''
+    CREATE TABLE meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    ''')
+    conn.execute("INSERT INTO meta (key, value) VALUES ('terminal_id', lower(hex(randomblob(8))))")
+
+    conn.execute('ALTER TABLE inspections ADD COLUMN uid TEXT')
+    conn.execute('UPDATE inspections SET uid = lower(hex(randomblob(16)))')
+    conn.execute('CREATE UNIQUE INDEX idx_inspections_uid ON inspections (uid)')
+
+    conn.execute('''
+    CREATE TABLE change_journal (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        inspection_id INTEGER NOT NULL
+    )
+    ''')
+    conn.execute('INSERT INTO change_journal (inspection_id) SELECT ID FROM inspections ORDER BY ID')
+    conn.execute('''
+    CREATE TRIGGER inspections_journal_ai AFTER INSERT ON inspections
+    BEGIN
+        INSERT INTO change_journal (inspection_id) VALUES (NEW.ID);
+    END
+    ''')
+    for action in ('UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER change_journal_no_{action.lower()} BEFORE {action} ON change_journal
+        BEGIN
+            SELECT RAISE(ABORT, 'Журнал изменений только дополняется');
+        END
+        ''')
+
+    # Докуда уже объединены журналы других терминалов (заполняется в центральной БД)
+    conn.execute('''
+    CREATE TABLE sync_state (
+        terminal_id TEXT PRIMARY KEY,
+        last_seq INTEGER NOT NULL
+    )
+    ''')
+
+
+def _migrate_search(conn):
+    # Полнотекстовый индекс FTS5 по примечанию, наименованию и ФИО. Таблица внешнего
+    # содержимого (content='inspections') хранит только индекс, тексты берутся из inspections
+    columns = ', '.join(SEARCH_COLUMNS)
+    new_values = ', '.join(f'NEW.{column}' for column in SEARCH_COLUMNS)
+    old_values = ', '.join(f'OLD.{column}' for column in SEARCH_COLUMNS)
+    conn.execute(f'''
+    CREATE VIRTUAL TABLE inspections_fts USING fts5(
+        {columns},
+        content='inspections', content_rowid='ID',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+    conn.execute(f'''
+    CREATE TRIGGER inspections_fts_ai AFTER INSERT ON inspections
+    BEGIN
+        INSERT INTO inspections_fts (rowid, {columns}) VALUES (NEW.ID, {new_values});
+    END
+    ''')
+    conn.execute(f'''
+    CREATE TRIGGER inspections_fts_ad AFTER DELETE ON inspections
+    BEGIN
+        INSERT INTO inspections_fts (inspections_fts, rowid, {columns}) VALUES ('delete', OLD.ID, {old_values});
+    END
+    ''')
+    conn.execute(f'''
+    CREATE TRIGGER inspections_fts_au AFTER UPDATE ON inspections
+    BEGIN
+        INSERT INTO inspections_fts (inspections_fts, rowid, {columns}) VALUES ('delete', OLD.ID, {old_values});
+        INSERT INTO inspections_fts (rowid, {columns}) VALUES (NEW.ID, {new_values});
+    END
+    ''')
+    # Индексируем уже существующие записи
+    conn.execute("INSERT INTO inspections_fts (inspections_fts) VALUES ('rebuild')")
+
+
+def _migrate_sync_uid(conn):
+    # uid записи на последней объединенной позиции журнала: по нему видно, что журнал
+    # пришел от того же терминала, а не от копии его файла с тем же terminal_id
+    conn.execute('ALTER TABLE sync_state ADD COLUMN last_uid TEXT')
+
+
+# Миграции схемы по порядку: MIGRATIONS[i] переводит БД с версии i на версию i + 1.
+# Текущая версия хранится в PRAGMA user_version.
+MIGRATIONS = [
+    _migrate_iso_dates,
+    _migrate_rollups,
+    _migrate_normalized,
+    _migrate_journal,
+    _migrate_search,
+    _migrate_sync_uid,
+]
+
+
+def _load_defects(conn, records):
+    # records - {ID записи: словарь с пустым 'defects'}; дефекты дописываются одним запросом
+    if records:
+        placeholders = ', '.join('?' * len(records))
+        for inspection_id, code, qty in conn.execute(
+            f'SELECT inspection_id, defect_code, qty FROM inspection_defects WHERE inspection_id IN ({placeholders})',
+            list(records)
+        ):
+            records[inspection_id]['defects'][code] = qty
+
+
+def _apply_bulk_triggers(conn, records, first_id, last_id):
+    # То же, что делают BULK_TRIGGERS для записей с ID first_id..last_id, но одним запросом
+    # на журнал и FTS и одной пачкой upsert на каждую сводку
+    conn.execute(
+        'INSERT INTO change_journal (inspection_id) SELECT ID FROM inspections WHERE ID BETWEEN ? AND ? ORDER BY ID',
+        (first_id, last_id)
+    )
+    columns = ', '.join(SEARCH_COLUMNS)
+    conn.execute(
+        f'INSERT INTO inspections_fts (rowid, {columns}) SELECT ID, {columns} FROM inspections WHERE ID BETWEEN ? AND ?',
+        (first_id, last_id)
+    )
+    for table, key, source in ROLLUPS:
+        deltas = {}
+        for record in records:
+            group = (record.get(source) or '', record.get('Контроль_дата_приемки') or '')
+            values = [(metric, record.get(column) if column else 1) for metric, column in HEADER_METRICS]
+            values.extend(record.get('defects', {}).items())
+            for metric, qty in values:
+                if qty is not None and qty > 0:
+                    deltas[(*group, metric)] = deltas.get((*group, metric), 0) + qty
+        conn.executemany(f'''
+        INSERT INTO {table} ({key}, day, metric, qty) VALUES (?, ?, ?, ?)
+        ON CONFLICT ({key}, day, metric) DO UPDATE SET qty = qty + excluded.qty
+        ''', [(*group, qty) for group, qty in deltas.items()])
+
+
+def _known_uids(conn, uids, chunk=500):
+    uids = list(uids)
+    known = set()
+    for start in range(0, len(uids), chunk):
+        part = uids[start:start + chunk]
+        known.update(uid for uid, in conn.execute(
+            f'SELECT uid FROM inspections WHERE uid IN ({", ".join("?" * len(part))})', part
+        ))
+    return known
+
 
 class Database:
-    def __init__(self, db_name='castings.db'):
+    INSERT_QUERY = (
+        f'INSERT INTO inspections (ID, uid, {", ".join(HEADER_COLUMNS)}) '
+        f'VALUES ({", ".join("?" * (len(HEADER_COLUMNS) + 2))})'
+    )
+    # Следующий свободный ID: sqlite_sequence помнит и ID удаленных (архивированных) записей
+    NEXT_ID_QUERY = '''
+    SELECT max(coalesce((SELECT MAX(ID) FROM inspections), 0),
+               coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'inspections'), 0)) + 1
+    '''
+    INSERT_DEFECT_QUERY = 'INSERT INTO inspection_defects (inspection_id, defect_code, qty) VALUES (?, ?, ?)'
+
+    def __init__(self, db_name='castings.db', synchronous='NORMAL', busy_timeout=5000,
+                 cache_size=-16000, mmap_size=64 * 1024 * 1024):
         self.db_name = db_name
+        # synchronous: 'OFF' | 'NORMAL' | 'FULL' | 'EXTRA'; в режиме WAL 'NORMAL' не теряет
+        # целостность БД, а fsync делается только при checkpoint
+        self.synchronous = synchronous
+        # Сколько миллисекунд ждать освобождения блокировки вместо ошибки "database is locked"
+        self.busy_timeout = busy_timeout
+        # Размер кэша страниц (отрицательное значение - в КиБ) и объем отображения файла в память
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
         self.thread_local = threading.local()
+        # Все открытые соединения, чтобы закрыть их при выходе из приложения
+        self.connections = []
+        self.connections_lock = threading.Lock()
         self.create_table()
 
+    def _connect(self, readonly=False):
+        if readonly:
+            # Соединение только для чтения: в режиме WAL не мешает записи и не ждет ее
+            uri = Path(self.db_name).resolve().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_name, check_same_thread=False)
+            conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+            # Проверяем, что коды дефектов есть в справочнике
+            conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA cache_size = {int(self.cache_size)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        METRICS.install_trace(conn)
+        METRICS.count('db_connections_opened_total', mode='ro' if readonly else 'rw')
+        with self.connections_lock:
+            self.connections.append((conn, readonly))
+        return conn
+
+    @METRICS.timed('db_get_connection_seconds')
     def get_connection(self):
+        """Соединение для записи, свое для каждого потока"""
         if not hasattr(self.thread_local, "connection"):
-            self.thread_local.connection = sqlite3.connect(self.db_name)
+            self.thread_local.connection = self._connect()
         return self.thread_local.connection
 
+    def get_read_connection(self):
+        """Соединение только для чтения (отчеты, выгрузка), свое для каждого потока"""
+        if not hasattr(self.thread_local, "read_connection"):
+            self.thread_local.read_connection = self._connect(readonly=True)
+        return self.thread_local.read_connection
+
+    def close(self):
+        """Закрывает все открытые соединения (вызывается при выходе из приложения)"""
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+            # Новый threading.local сбрасывает ссылки на закрытые соединения во всех потоках
+            self.thread_local = threading.local()
+        # Соединение только для чтения не может перенести WAL в основной файл, поэтому
+        # сначала закрываются они, а перед закрытием последнего соединения для записи
+        # выполняется checkpoint: файл БД можно копировать без файла -wal
+        connections.sort(key=lambda item: not item[1])
+        for index, (conn, readonly) in enumerate(connections):
+            if not readonly and index == len(connections) - 1:
+                try:
+                    conn.commit()
+                    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                except sqlite3.Error:
+                    # БД занята другим процессом - WAL перенесет он или следующий запуск
+                    pass
+            conn.close()
+
     def create_table(self):
         conn = self.get_connection()
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS castings (
-            ID INTEGER PRIMARY KEY AUTOINCREMENT,
-            Наименование_отливки TEXT,
-            Исполнитель1 TEXT,
-            Исполнитель2 TEXT,
-            Контролер1 TEXT,
-            Контролер2 TEXT,
-            Контроль_подано INTEGER,
-            Контроль_дата_приемки DATE,
-            Контроль_принято INTEGER,
-            Второй_сорт_раковины INTEGER,
-            Второй_сорт_зарез INTEGER,
-            Второй_сорт_прочее INTEGER,
-            Доработка_лапы INTEGER,
-            Доработка_питатель INTEGER,
-            Доработка_корона INTEGER,
-            Окончательный_брак_Недолив INTEGER,
-            Окончательный_брак_Вырыв INTEGER,
-            Окончательный_брак_Зарез INTEGER,
-            Окончательный_брак_Коробление INTEGER,
-            Окончательный_брак_Наплыв_металла INTEGER,
-            Окончательный_брак_Нарушение_геометрии INTEGER,
-            Окончательный_брак_Нарушение_маркировки INTEGER,
-            Окончательный_брак_Непроклей INTEGER,
-            Окончательный_брак_Неслитина INTEGER,
-            Окончательный_брак_Несоответствие_внешнего_вида INTEGER,
-            Окончательный_брак_Несоответствие_размеров INTEGER,
-            Окончательный_брак_Пеномодель INTEGER,
-            Окончательный_брак_Пористость INTEGER,
-            Окончательный_брак_Пригар_песка INTEGER,
-            Окончательный_брак_Рыхлота INTEGER,
-            Окончательный_брак_Раковины INTEGER,
-            Окончательный_брак_Скол INTEGER,
-            Окончательный_брак_Слом INTEGER,
-            Окончательный_брак_Спай INTEGER,
-            Окончательный_брак_Трещины INTEGER,
-            Окончательный_брак_Прочее INTEGER,
-            Примечание TEXT
-        )
-        ''')
-        conn.commit()
+        if not conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0]:
+            # Новая БД: освобожденные страницы возвращаются через PRAGMA incremental_vacuum
+            # (для существующей БД режим меняет maintenance.compact через VACUUM)
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # WAL сохраняется в самом файле БД: читатели не блокируют запись и наоборот
+        conn.execute('PRAGMA journal_mode = WAL')
+        if conn.execute('PRAGMA user_version').fetchone()[0] == 0:
+            # Исходная схема; дальше ее развивают миграции из MIGRATIONS
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS castings (
+                ID INTEGER PRIMARY KEY AUTOINCREMENT,
+                Наименование_отливки TEXT,
+                Исполнитель1 TEXT,
+                Исполнитель2 TEXT,
+                Контролер1 TEXT,
+                Контролер2 TEXT,
+                Контроль_подано INTEGER,
+                Контроль_дата_приемки DATE,
+                Контроль_принято INTEGER,
+                Второй_сорт_раковины INTEGER,
+                Второй_сорт_зарез INTEGER,
+                Второй_сорт_прочее INTEGER,
+                Доработка_лапы INTEGER,
+                Доработка_питатель INTEGER,
+                Доработка_корона INTEGER,
+                Окончательный_брак_Недолив INTEGER,
+                Окончательный_брак_Вырыв INTEGER,
+                Окончательный_брак_Зарез INTEGER,
+                Окончательный_брак_Коробление INTEGER,
+                Окончательный_брак_Наплыв_металла INTEGER,
+                Окончательный_брак_Нарушение_геометрии INTEGER,
+                Окончательный_брак_Нарушение_маркировки INTEGER,
+                Окончательный_брак_Непроклей INTEGER,
+                Окончательный_брак_Неслитина INTEGER,
+                Окончательный_брак_Несоответствие_внешнего_вида INTEGER,
+                Окончательный_брак_Несоответствие_размеров INTEGER,
+                Окончательный_брак_Пеномодель INTEGER,
+                Окончательный_брак_Пористость INTEGER,
+                Окончательный_брак_Пригар_песка INTEGER,
+                Окончательный_брак_Рыхлота INTEGER,
+                Окончательный_брак_Раковины INTEGER,
+                Окончательный_брак_Скол INTEGER,
+                Окончательный_брак_Слом INTEGER,
+                Окончательный_брак_Спай INTEGER,
+                Окончательный_брак_Трещины INTEGER,
+                Окончательный_брак_Прочее INTEGER,
+                Примечание TEXT
+            )
+            ''')
+            conn.commit()
+        self.migrate()
+
+    def migrate(self):
+        """Применяет недостающие миграции схемы, каждую в отдельной транзакции"""
+        conn = self.get_connection()
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > len(MIGRATIONS):
+            raise RuntimeError(
+                f'База данных {self.db_name} создана более новой версией программы '
+                f'(версия схемы {version})'
+            )
+
+        for target in range(version + 1, len(MIGRATIONS) + 1):
+            # BEGIN IMMEDIATE сразу берет блокировку записи, поэтому два процесса
+            # не применят одну и ту же миграцию дважды
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                current = conn.execute('PRAGMA user_version').fetchone()[0]
+                if current < target:
+                    MIGRATIONS[target - 1](conn)
+                    conn.execute(f'PRAGMA user_version = {target}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def defect_types(self):
+        """Справочник видов дефектов: [(код, категория, подпись)] в порядке формы"""
+        return self.get_connection().execute(DEFECT_TYPES_QUERY).fetchall()
+
+    def add_defect_type(self, code, category, label):
+        """Добавляет вид дефекта в справочник и перестраивает представление castings"""
+        if not code.isidentifier():
+            raise ValueError(f'Код дефекта должен быть идентификатором: {code!r}')
+        if category not in dict(DEFECT_CATEGORIES):
+            raise ValueError(f'Неизвестная категория дефекта: {category!r}')
+        conn = self.get_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                '''INSERT INTO defect_types (code, category, label, position)
+                   SELECT ?, ?, ?, coalesce(MAX(position), -1) + 1 FROM defect_types''',
+                (code, category, label)
+            )
+            _create_castings_view(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _insert(self, conn, records, skip_existing=False):
+        # Заголовки и дефекты вставляются двумя executemany. ID назначаются заранее под
+        # блокировкой записи (BEGIN IMMEDIATE): после всех когда-либо выданных ID, включая
+        # записи, перенесенные в архив. Транзакцию завершает вызывающий код.
+        # skip_existing: записи с уже известным uid пропускаются (повторное объединение)
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        rows = [(record.get('uid') or uuid.uuid4().hex, record) for record in records]
+        if skip_existing:
+            rows = self._skip_known_uids(conn, rows)
+        next_id = conn.execute(self.NEXT_ID_QUERY).fetchone()[0]
+        ids = list(range(next_id, next_id + len(rows)))
+        # Для больших пачек построчные триггеры (сводки, журнал, FTS) снимаются на время
+        # вставки и заменяются пакетными запросами. DDL в SQLite транзакционен: другие
+        # соединения не видят схему без триггеров, а при ошибке откат вернет их на место.
+        triggers = []
+        if len(rows) >= BULK_INSERT_MIN:
+            placeholders = ', '.join('?' * len(BULK_TRIGGERS))
+            triggers = conn.execute(
+                f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN ({placeholders})",
+                BULK_TRIGGERS
+            ).fetchall()
+            for name, _ in triggers:
+                conn.execute(f'DROP TRIGGER {name}')
+        conn.executemany(self.INSERT_QUERY, (
+            [record_id, uid] + [record.get(column) for column in HEADER_COLUMNS]
+            for record_id, (uid, record) in zip(ids, rows)
+        ))
+        conn.executemany(self.INSERT_DEFECT_QUERY, (
+            (record_id, code, qty)
+            for record_id, (_, record) in zip(ids, rows)
+            for code, qty in record.get('defects', {}).items()
+            if qty
+        ))
+        if triggers:
+            _apply_bulk_triggers(conn, [record for _, record in rows], ids[0], ids[-1])
+            for _, sql in triggers:
+                conn.execute(sql)
+        return ids
+
+    @staticmethod
+    def _skip_known_uids(conn, rows):
+        # Убирает записи, uid которых уже есть в БД или повторяется в самой пачке
+        known = _known_uids(conn, {uid for uid, _ in rows})
+        result = []
+        for uid, record in rows:
+            if uid not in known:
+                known.add(uid)
+                result.append((uid, record))
+        return result
+
+    def known_uids(self, uids):
+        """Какие из uids уже есть в БД (множество)"""
+        return _known_uids(self.get_connection(), uids)
+
+    @METRICS.timed('db_insert_record_seconds')
+    def insert_record(self, record):
+        """Сохраняет одну запись.
+
+        record - словарь {колонка из HEADER_COLUMNS: значение, 'defects': {код дефекта: количество}},
+        необязательный 'uid' задает глобальный идентификатор (по умолчанию новый UUID).
+        Возвращает ID записи.
+        """
+        return self._write([record])[0]
+
+    @METRICS.timed('db_insert_many_seconds')
+    def insert_many(self, records):
+        """Вставляет пачку записей одной транзакцией (один commit на всю пачку); возвращает их ID.
+
+        Заголовки и дефекты пишутся через executemany, ID назначаются подряд под блокировкой записи.
+        Для пачек от BULK_INSERT_MIN записей сводки, журнал и FTS обновляются пакетно, без
+        построчных триггеров (импорт, синхронизация).
+        """
+        return self._write(records)
 
-    def insert_record(self, data):
+    def _write(self, records):
+        # Как "with conn", но commit замеряется отдельно: ожидание блокировки и fsync видны в метриках
         conn = self.get_connection()
-        query = '''INSERT INTO castings (
-            Наименование_отливки, Исполнитель1, Исполнитель2,
-            Контролер1, Контролер2,
-            Контроль_подано, Контроль_дата_приемки, Контроль_принято,
-            Второй_сорт_раковины, Второй_сорт_зарез, Второй_сорт_прочее,
-            Доработка_лапы, Доработка_питатель, Доработка_корона,
-            Окончательный_брак_Недолив, Окончательный_брак_Вырыв,
-            Окончательный_брак_Зарез, Окончательный_брак_Коробление,
-            Окончательный_брак_Наплыв_металла, Окончательный_брак_Нарушение_геометрии,
-            Окончательный_брак_Нарушение_маркировки, Окончательный_брак_Непроклей,
-            Окончательный_брак_Неслитина, Окончательный_брак_Несоответствие_внешнего_вида,
-            Окончательный_брак_Несоответствие_размеров, Окончательный_брак_Пеномодель,
-            Окончательный_брак_Пористость, Окончательный_брак_Пригар_песка,
-            Окончательный_брак_Рыхлота, Окончательный_брак_Раковины,
-            Окончательный_брак_Скол, Окончательный_брак_Слом,
-            Окончательный_брак_Спай, Окончательный_брак_Трещины,
-            Окончательный_брак_Прочее, Примечание
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
-        
-        conn.execute(query, data)
-        conn.commit() 
\ No newline at end of file
+        try:
+            ids = self._insert(conn, records)
+            with METRICS.timer('db_commit_seconds'):
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            METRICS.count('db_write_errors_total')
+            raise
+        METRICS.count('db_records_inserted_total', len(ids))
+        return ids
+
+    @property
+    def terminal_id(self):
+        """Идентификатор этой БД (терминала) для объединения данных"""
+        return self.get_connection().execute("SELECT value FROM meta WHERE key = 'terminal_id'").fetchone()[0]
+
+    def synced_position(self):
+        """До какой позиции своего журнала этот терминал уже перенесен в центральную БД.
+
+        None - БД еще ни разу не передавала свой журнал (центральная БД или отдельная установка).
+        """
+        row = self.get_connection().execute("SELECT value FROM meta WHERE key = 'synced_seq'").fetchone()
+        return int(row[0]) if row else None
+
+    def mark_synced(self, seq):
+        """Запоминает, что журнал этого терминала до позиции seq есть в центральной БД"""
+        conn = self.get_connection()
+        with conn:
+            conn.execute('''
+            INSERT INTO meta (key, value) VALUES ('synced_seq', ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            ''', (str(seq),))
+
+    def new_terminal_id(self):
+        """Назначает БД новый идентификатор терминала (для файла, скопированного с другого терминала).
+
+        Журнал копии заново передается в центральную БД под новым идентификатором;
+        уже известные там записи пропускаются по uid.
+        """
+        conn = self.get_connection()
+        with conn:
+            conn.execute("UPDATE meta SET value = lower(hex(randomblob(8))) WHERE key = 'terminal_id'")
+            # Копия остается терминалом, но свой журнал в центральную БД еще не передавала
+            conn.execute("UPDATE meta SET value = '0' WHERE key = 'synced_seq'")
+        return self.terminal_id
+
+    def journal_entry(self, seq):
+        """Позиция seq журнала: (uid записи,) или None, если такой позиции в журнале нет.
+
+        uid равен None, если запись уже перенесена в архив.
+        """
+        return self.get_read_connection().execute('''
+        SELECT i.uid FROM change_journal AS j
+        LEFT JOIN inspections AS i ON i.ID = j.inspection_id
+        WHERE j.seq = ?
+        ''', (seq,)).fetchone()
+
+    def journal_since(self, seq, limit=1000):
+        """Записи из журнала изменений после позиции seq: ([записи с 'uid'], последняя позиция).
+
+        Позиция равна None, если новых записей нет. Чтение идет по первичному ключу журнала,
+        поэтому стоимость зависит только от количества новых записей.
+        """
+        conn = self.get_read_connection()
+        header = ', '.join(f'i.{column}' for column in HEADER_COLUMNS)
+        rows = conn.execute(f'''
+        SELECT j.seq, i.ID, i.uid, {header}
+        FROM change_journal AS j
+        LEFT JOIN inspections AS i ON i.ID = j.inspection_id
+        WHERE j.seq > ?
+        ORDER BY j.seq
+        LIMIT ?
+        ''', (seq, limit)).fetchall()
+        if not rows:
+            return [], None
+
+        # Запись могла быть удалена (перенесена в архив) - позицию журнала все равно сдвигаем
+        records = {}
+        for row in rows:
+            if row[1] is not None:
+                records[row[1]] = dict(zip(HEADER_COLUMNS, row[3:]), uid=row[2], defects={})
+        _load_defects(conn, records)
+        return list(records.values()), rows[-1][0]
+
+    def recent_inspections(self, limit=50):
+        """Последние limit записей (по ID, новые первыми) в виде словарей с 'ID', 'uid' и 'defects'"""
+        conn = self.get_read_connection()
+        header = ', '.join(HEADER_COLUMNS)
+        rows = conn.execute(f'SELECT ID, uid, {header} FROM inspections ORDER BY ID DESC LIMIT ?', (limit,))
+        records = {row[0]: dict(zip(HEADER_COLUMNS, row[2:]), ID=row[0], uid=row[1], defects={}) for row in rows}
+        _load_defects(conn, records)
+        return list(records.values())
+
+    def sync_position(self, terminal_id):
+        """До какой позиции журнала терминала terminal_id данные уже объединены в эту БД"""
+        return self.sync_state(terminal_id)[0]
+
+    def sync_state(self, terminal_id):
+        """(позиция журнала терминала terminal_id, uid записи на этой позиции или None)"""
+        row = self.get_connection().execute(
+            'SELECT last_seq, last_uid FROM sync_state WHERE terminal_id = ?', (terminal_id,)
+        ).fetchone()
+        return tuple(row) if row else (0, None)
+
+    def merge_records(self, terminal_id, records, last_seq, last_uid=None):
+        """Добавляет записи другого терминала и сдвигает его позицию журнала одной транзакцией.
+
+        last_uid - uid записи на позиции last_seq: по нему следующая синхронизация проверяет,
+        что журнал пришел от того же терминала. Записи с уже известным uid пропускаются,
+        поэтому повтор пачки безопасен. Возвращает количество действительно добавленных записей.
+        """
+        conn = self.get_connection()
+        with conn:
+            inserted = self._insert(conn, records, skip_existing=True)
+            conn.execute('''
+            INSERT INTO sync_state (terminal_id, last_seq, last_uid) VALUES (?, ?, ?)
+            ON CONFLICT (terminal_id) DO UPDATE SET last_seq = excluded.last_seq, last_uid = excluded.last_uid
+            ''', (terminal_id, last_seq, last_uid))
+        return len(inserted)
+
+    def recent_values(self, columns, limit=50000):
+        """Различные непустые значения из колонок inspections, от давно использованных к недавним.
+
+        Используется для начальной загрузки подсказок в форме.
+        """
+        union = ' UNION ALL '.join(f'SELECT {column} AS value, ID FROM inspections' for column in columns)
+        rows = self.get_read_connection().execute(f'''
+        SELECT value FROM ({union})
+        WHERE value IS NOT NULL AND value <> ''
+        GROUP BY value
+        ORDER BY MAX(ID) DESC
+        LIMIT ?
+        ''', (limit,)).fetchall()
+        return [value for value, in reversed(rows)]
+
+    def search(self, query, limit=50, raw=False):
+        """Полнотекстовый поиск по примечанию, наименованию отливки и ФИО.
+
+        Каждое слово запроса ищется как префикс ("трещ" найдет "трещина"), все слова
+        должны встретиться в записи. raw=True передает запрос в синтаксисе FTS5 как есть.
+        Возвращает [(ID, наименование, дата приемки, примечание, фрагмент, ранг)],
+        лучшие совпадения первыми.
+        """
+        if not raw:
+            words = re.findall(r'\w+', query)
+            if not words:
+                return []
+            query = ' '.join(f'"{word}"*' for word in words)
+        return self.get_read_connection().execute('''
+        SELECT i.ID, i.Наименование_отливки, i.Контроль_дата_приемки, i.Примечание,
+               snippet(inspections_fts, -1, '[', ']', '…', 12), inspections_fts.rank
+        FROM inspections_fts
+        JOIN inspections AS i ON i.ID = inspections_fts.rowid
+        WHERE inspections_fts MATCH ?
+        ORDER BY inspections_fts.rank
+        LIMIT ?
+        ''', (query, limit)).fetchall()
+
+    def rebuild_rollups(self):
+        """Пересчитывает сводные таблицы заново по всем записям, включая архивные.
+
+        Архивы (maintenance.archive_records) подключаются на время пересчета; если все
+        подключить нельзя (лимит ATTACH в SQLite), пересчет не выполняется.
+        """
+        from maintenance import archive_paths, attach_archives
+
+        conn = self.get_connection()
+        conn.commit()
+        expected = list(archive_paths(self))
+        attached = attach_archives(self, conn) if expected else []
+        try:
+            if attached != expected:
+                raise RuntimeError(
+                    f'Не удалось подключить все архивы ({len(attached)} из {len(expected)}), '
+                    f'сводки не пересчитаны'
+                )
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if expected:
+                    _rebuild_rollups(conn, 'temp.all_inspections', 'temp.all_inspection_defects')
+                else:
+                    _rebuild_rollups(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        finally:
+            if expected:
+                conn.execute('DROP VIEW IF EXISTS temp.all_inspections')
+                conn.execute('DROP VIEW IF EXISTS temp.all_inspection_defects')
+                for year in attached:
+                    conn.execute(f'DETACH DATABASE archive_{year}')
+
+    def defect_pareto(self, days=30, casting=None, controller=None):
+        """Парето дефектов за последние days дней по сводкам.
+
+        Возвращает [(дефект, количество, доля, накопленная доля)] по убыванию количества.
+        Можно ограничить одной отливкой или одним контролером, но не обоими сразу:
+        в сводке по отливкам нет контролера, а в сводке по контролерам - отливки.
+        """
+        if casting is not None and controller is not None:
+            raise ValueError('Парето строится по отливке или по контролеру, но не по обоим сразу')
+        since = (date.today() - timedelta(days=days - 1)).isoformat()
+        if controller is not None:
+            table, key, value = 'rollup_controller_day', 'controller', controller
+        else:
+            table, key, value = 'rollup_casting_day', 'casting', casting
+
+        placeholders = ', '.join('?' * len(HEADER_METRICS))
+        query = f'SELECT metric, SUM(qty) FROM {table} WHERE day >= ? AND metric NOT IN ({placeholders})'
+        params = [since, *(metric for metric, _ in HEADER_METRICS)]
+        if value is not None:
+            query += f' AND {key} = ?'
+            params.append(value)
+        query += ' GROUP BY metric ORDER BY SUM(qty) DESC'
+
+        rows = self.get_read_connection().execute(query, params).fetchall()
+        total = sum(qty for _, qty in rows)
+        result = []
+        cumulative = 0
+        for metric, qty in rows:
+            cumulative += qty
+            result.append((metric, qty, qty / total, cumulative / total))
+        return result
+
+    def defect_summary(self, date_from, date_to, group='casting', period='day'):
+        """Сумма подано/принято/второй сорт/доработка/окончательный брак
+        по отливкам (group='casting') или контролерам (group='controller')
+        за период с разбивкой по дням, неделям или месяцам."""
+        table, key = {
+            'casting': ('rollup_casting_day', 'casting'),
+            'controller': ('rollup_controller_day', 'controller'),
+        }[group]
+        period_expr = {
+            'day': 'r.day',
+            'week': "strftime('%Y-W%W', r.day)",
+            'month': 'substr(r.day, 1, 7)',
+        }[period]
+
+        query = f'''
+        SELECT r.{key}, {period_expr} AS period,
+               SUM(CASE WHEN r.metric = 'submitted' THEN r.qty ELSE 0 END),
+               SUM(CASE WHEN r.metric = 'accepted' THEN r.qty ELSE 0 END),
+               SUM(CASE WHEN t.category = 'second_grade' THEN r.qty ELSE 0 END),
+               SUM(CASE WHEN t.category = 'rework' THEN r.qty ELSE 0 END),
+               SUM(CASE WHEN t.category = 'final' THEN r.qty ELSE 0 END)
+        FROM {table} AS r
+        LEFT JOIN defect_types AS t ON t.code = r.metric
+        WHERE r.day BETWEEN ? AND ?
+        GROUP BY r.{key}, period
+        ORDER BY period, r.{key}
+        '''
+        return self.get_read_connection().execute(query, (date_from, date_to)).fetchall()
+
+    def casting_totals(self, date_from=None):
+        """Суммы по сводкам для каждой отливки: [(отливка, показатель, количество)].
+
+        Показатель - 'inspections', 'submitted', 'accepted' или категория дефекта.
+        """
+        query = '''
+        SELECT r.casting, coalesce(t.category, r.metric), SUM(r.qty)
+        FROM rollup_casting_day AS r
+        LEFT JOIN defect_types AS t ON t.code = r.metric
+        '''
+        params = []
+        if date_from:
+            query += ' WHERE r.day >= ?'
+            params.append(date_from)
+        query += ' GROUP BY 1, 2'
+        return self.get_read_connection().execute(query, params).fetchall()
+
+    def category_counts(self, date_from=None):
+        """Курсор по записям: (ID, отливка, подано, дефекты по каждой категории DEFECT_CATEGORIES).
+
+        Порядок - по дате приемки и ID; используется для пакетного расчета контрольных карт.
+        """
+        sums = ', '.join(
+            f"coalesce(SUM(CASE WHEN t.category = '{category}' THEN d.qty END), 0)"
+            for category, _ in DEFECT_CATEGORIES
+        )
+        query = f'''
+        SELECT i.ID, i.Наименование_отливки, i.Контроль_подано, {sums}
+        FROM inspections AS i
+        LEFT JOIN inspection_defects AS d ON d.inspection_id = i.ID
+        LEFT JOIN defect_types AS t ON t.code = d.defect_code
+        '''
+        params = []
+        if date_from:
+            query += ' WHERE i.Контроль_дата_приемки >= ?'
+            params.append(date_from)
+        query += ' GROUP BY i.ID ORDER BY i.Контроль_дата_приемки, i.ID'
+        return self.get_read_connection().execute(query, params)
+
+    def iter_records(self, date_from=None, date_to=None, batch_size=5000):
+        """Построчно отдает широкие записи за период, читая курсор пачками.
+
+        Строка: ID, колонки BASIC_FIELDS, количества по всем видам дефектов
+        (в порядке defect_types()), примечание - как в представлении castings.
+        Весь результат в память не загружается, поэтому подходит для выгрузки любого объема.
+        """
+        codes = {code: i for i, (code, _, _) in enumerate(self.defect_types())}
+        basic = [column for column, _ in BASIC_FIELDS]
+        query = f'''
+        SELECT i.ID, {", ".join("i." + column for column in basic)}, i.{NOTES_COLUMN}, d.defect_code, d.qty
+        FROM inspections AS i
+        LEFT JOIN inspection_defects AS d ON d.inspection_id = i.ID
+        '''
+        conditions, params = [], []
+        if date_from:
+            conditions.append('i.Контроль_дата_приемки >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append('i.Контроль_дата_приемки <= ?')
+            params.append(date_to)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY i.Контроль_дата_приемки, i.ID'
+
+        # Строки дефектов одной записи идут подряд - собираем их в широкую строку
+        cursor = self.get_read_connection().execute(query, params)
+        header = None
+        defects = None
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    if header is None or row[0] != header[0]:
+                        if header is not None:
+                            yield (*header[:-1], *defects, header[-1])
+                        header = row[:-2]
+                        defects = [0] * len(codes)
+                    if row[-2] is not None:
+                        defects[codes[row[-2]]] = row[-1]
+            if header is not None:
+                yield (*header[:-1], *defects, header[-1])
+        finally:
+            cursor.close()
@@ -0,0 +1,55 @@
+import csv
+import sys
+import time
+
+from fields import column_headers
+
+
+def write_csv(rows, headers, path, delimiter=';'):
+    # utf-8-sig и ';' - чтобы файл сразу корректно открывался в русском Excel
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_xlsx(rows, headers, path):
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise RuntimeError('Для выгрузки в XLSX установите пакет openpyxl (pip install openpyxl)')
+
+    # write_only-книга сразу сбрасывает строки на диск и не держит лист в памяти
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Отливки')
+    sheet.append(headers)
+    count = 0
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    workbook.save(path)
+    return count
+
+
+WRITERS = {
+    'csv': write_csv,
+    'xlsx': write_xlsx,
+}
+
+
+def export_records(db, path, fmt='csv', date_from=None, date_to=None, batch_size=5000):
+    """Выгружает записи за период в файл потоком; возвращает (количество строк, секунды)"""
+    started = time.perf_counter()
+    headers = ['ID'] + column_headers(db.defect_types())
+    rows = db.iter_records(date_from, date_to, batch_size=batch_size)
+    count = WRITERS[fmt](rows, headers, path)
+    return count, time.perf_counter() - started
+
+
+def report(count, elapsed, stream=sys.stderr):
+    rate = count / elapsed if elapsed > 0 else 0
+    print(f'Выгружено записей: {count} за {elapsed:.2f} с ({rate:.0f} записей/с)', file=stream)
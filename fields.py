@@ -0,0 +1,53 @@
+# Описание полей формы: подписи и соответствующие колонки БД.
+# Модуль не зависит от toga, поэтому используется и формой, и выгрузкой отчетов.
+
+# (колонка БД, подпись в форме)
+BASIC_FIELDS = [
+    ('Наименование_отливки', 'Наименование отливки:'),
+    ('Исполнитель1', 'Исполнитель 1:'),
+    ('Исполнитель2', 'Исполнитель 2:'),
+    ('Контролер1', 'Контролер 1:'),
+    ('Контролер2', 'Контролер 2:'),
+    ('Контроль_подано', 'Контроль подано:'),
+    ('Контроль_дата_приемки', 'Дата приемки:'),
+    ('Контроль_принято', 'Контроль принято:'),
+]
+
+NOTES_COLUMN = 'Примечание'
+
+# Категории дефектов в порядке секций формы: (код категории, заголовок)
+DEFECT_CATEGORIES = [
+    ('second_grade', 'Второй сорт'),
+    ('rework', 'Доработка'),
+    ('final', 'Окончательный брак'),
+]
+
+# Начальное наполнение справочника видов дефектов (таблица defect_types):
+# (код = колонка в широком представлении castings, категория, подпись)
+DEFAULT_DEFECT_TYPES = [
+    ('Второй_сорт_раковины', 'second_grade', 'Раковины'),
+    ('Второй_сорт_зарез', 'second_grade', 'Зарез'),
+    ('Второй_сорт_прочее', 'second_grade', 'Прочее'),
+    ('Доработка_лапы', 'rework', 'Лапы'),
+    ('Доработка_питатель', 'rework', 'Питатель'),
+    ('Доработка_корона', 'rework', 'Корона'),
+] + [
+    ('Окончательный_брак_' + label.replace(' ', '_'), 'final', label)
+    for label in [
+        'Недолив', 'Вырыв', 'Зарез', 'Коробление', 'Наплыв металла', 'Нарушение геометрии', 'Нарушение маркировки',
+        'Непроклей', 'Неслитина', 'Несоответствие внешнего вида', 'Несоответствие размеров', 'Пеномодель', 'Пористость', 'Пригар песка',
+        'Рыхлота', 'Раковины', 'Скол', 'Слом', 'Спай', 'Трещины', 'Прочее',
+    ]
+]
+
+
+def column_headers(defect_types):
+    """Человекочитаемые заголовки колонок широкой записи (без ID).
+
+    defect_types - справочник [(код, категория, подпись)] в порядке колонок.
+    """
+    category_labels = dict(DEFECT_CATEGORIES)
+    headers = [label.rstrip(':') for _, label in BASIC_FIELDS]
+    headers += [f'{category_labels[category]}: {label}' for _, category, label in defect_types]
+    headers.append('Примечание')
+    return headers
@@ -0,0 +1,37 @@
+# Числовая часть формы без зависимости от toga: очистка ввода и расчет "Контроль принято"
+
+
+def clean_positive_integer(text):
+    """Оставляет в строке только цифры и убирает ведущие нули ('' для пустого ввода)"""
+    digits = ''.join(char for char in text or '' if char.isdecimal())
+    return str(int(digits)) if digits else ''
+
+
+def compute_accepted(submitted, defect_total):
+    """Контроль принято: подано минус все дефекты, но не меньше нуля"""
+    return max(0, (submitted or 0) - defect_total)
+
+
+class FormTotals:
+    """Кэш числовых полей формы и текущая сумма дефектов.
+
+    При изменении одного поля сумма корректируется на разницу значений,
+    поэтому пересчет "принято" не перечитывает остальные поля.
+    """
+
+    def __init__(self):
+        self.defects = {}
+        self.defect_total = 0
+        # None - количество поданных еще не введено
+        self.submitted = None
+
+    def set_defect(self, key, value):
+        self.defect_total += value - self.defects.get(key, 0)
+        self.defects[key] = value
+
+    def set_submitted(self, value):
+        self.submitted = value
+
+    @property
+    def accepted(self):
+        return compute_accepted(self.submitted, self.defect_total)
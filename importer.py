@@ -0,0 +1,252 @@
+import csv
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+from fields import BASIC_FIELDS, DEFECT_CATEGORIES, NOTES_COLUMN
+from form_model import compute_accepted
+
+
+def _normalize(header):
+    return ' '.join(str(header or '').replace('_', ' ').split()).rstrip(':').strip().casefold()
+
+
+def map_headers(headers, defect_types):
+    """Сопоставляет заголовки файла с колонками записи.
+
+    Понимает заголовки формы ('Наименование отливки:'), заголовки выгрузки
+    ('Второй сорт: Раковины') и имена колонок БД. Подпись дефекта без категории
+    ('Раковины' есть и во втором сорте, и в окончательном браке) относится к первой
+    еще не занятой категории в порядке формы.
+    Возвращает [(номер колонки, ('header', колонка) | ('defect', код) | ('uid', None))].
+    """
+    category_labels = dict(DEFECT_CATEGORIES)
+    targets = {}
+    for column, label in BASIC_FIELDS:
+        targets[_normalize(label)] = targets[_normalize(column)] = ('header', column)
+    targets[_normalize(NOTES_COLUMN)] = ('header', NOTES_COLUMN)
+    targets['uid'] = ('uid', None)
+    bare_labels = {}
+    for code, category, label in defect_types:
+        targets[_normalize(f'{category_labels[category]}: {label}')] = targets[_normalize(code)] = ('defect', code)
+        bare_labels.setdefault(_normalize(label), []).append(code)
+
+    mapping = []
+    used = set()
+    for index, header in enumerate(headers):
+        key = _normalize(header)
+        target = targets.get(key)
+        if target is None and key in bare_labels:
+            free = [code for code in bare_labels[key] if ('defect', code) not in used]
+            target = ('defect', free[0]) if free else None
+        if target is None or target in used:
+            continue
+        used.add(target)
+        mapping.append((index, target))
+
+    found = {target for _, target in mapping}
+    for column in ('Наименование_отливки', 'Контроль_подано', 'Контроль_дата_приемки'):
+        if ('header', column) not in found:
+            raise ValueError(f'В файле нет обязательной колонки {column}')
+    return mapping
+
+
+def _parse_count(value, name):
+    # Те же правила, что у полей формы: целое неотрицательное число, пустое поле - 0
+    if value is None or value == '':
+        return 0
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        if value < 0:
+            raise ValueError(f'{name}: отрицательное количество')
+        return value
+    text = str(value).strip()
+    if not text:
+        return 0
+    if not text.isdecimal():
+        raise ValueError(f'{name}: некорректное количество {text!r}')
+    return int(text)
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    text = str(value or '').strip().split(' ')[0]
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            pass
+    raise ValueError(f'Некорректная дата приемки {text!r}')
+
+
+def validate_chunk(mapping, first_line, rows):
+    """Проверяет пачку строк (выполняется в процессе пула).
+
+    Правила как в save_record: обязательны наименование, дата и количество поданных;
+    количества - целые неотрицательные; "Контроль принято" пересчитывается по дефектам.
+    Возвращает (записи [(номер строки, запись)], отклоненные [(номер строки, причина, исходная строка)]).
+    """
+    records, rejects = [], []
+    for line, row in enumerate(rows, start=first_line):
+        try:
+            record = {'defects': {}}
+            for index, (kind, target) in mapping:
+                value = row[index] if index < len(row) else None
+                if kind == 'defect':
+                    qty = _parse_count(value, target)
+                    if qty:
+                        record['defects'][target] = qty
+                elif kind == 'uid':
+                    record['uid'] = str(value).strip() if value else None
+                elif target == 'Контроль_подано':
+                    if value is None or str(value).strip() == '':
+                        raise ValueError('Не указано количество поданных на контроль')
+                    record[target] = _parse_count(value, target)
+                elif target == 'Контроль_дата_приемки':
+                    record[target] = _parse_date(value)
+                elif target != 'Контроль_принято':
+                    record[target] = str(value).strip() if value is not None else ''
+            if not record.get('Наименование_отливки'):
+                raise ValueError('Не указано наименование отливки')
+            record['Контроль_принято'] = compute_accepted(
+                record['Контроль_подано'], sum(record['defects'].values())
+            )
+            records.append((line, record))
+        except ValueError as e:
+            rejects.append((line, str(e), row))
+    return records, rejects
+
+
+def read_rows(path, delimiter=None):
+    """Строки файла CSV/XLSX как списки значений; первая строка - заголовки"""
+    if path.lower().endswith('.xlsx'):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise RuntimeError('Для импорта XLSX установите пакет openpyxl (pip install openpyxl)')
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in workbook.worksheets[0].iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            workbook.close()
+        return
+
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if delimiter is None:
+            # Выгрузка по умолчанию использует ';', сторонние файлы - часто ','
+            delimiter = ';' if f.readline().count(';') > 0 else ','
+            f.seek(0)
+        yield from csv.reader(f, delimiter=delimiter)
+
+
+def import_files(db, paths, rejects_path='import_rejects.csv', workers=None,
+                 chunk_size=5000, commit_size=50000, progress=None):
+    """Импорт файлов конвейером: чтение -> проверка в пуле процессов -> одна запись в БД.
+
+    Прочитанные строки пачками по chunk_size уходят на проверку в пул процессов;
+    проверенные записи собираются и сохраняются транзакциями по commit_size строк
+    (db.insert_many), пока пул проверяет следующие пачки. Отклоненные строки - и записи
+    с uid, который уже есть в БД или встречался раньше, - пишутся в rejects_path; файл
+    без обязательных колонок или нечитаемый файл тоже попадает туда одной строкой,
+    импорт продолжается со следующего файла.
+    progress(прочитано, импортировано, отклонено, секунд).
+    Возвращает (импортировано, отклонено, секунд).
+    """
+    workers = workers or os.cpu_count() or 1
+    defect_types = db.defect_types()
+    started = time.perf_counter()
+    read = imported = rejected = 0
+    pending = []
+    # uid записей, уже поставленных в импорт в этом запуске
+    seen_uids = set()
+
+    def flush():
+        nonlocal imported, pending
+        if pending:
+            db.insert_many(pending)
+            imported += len(pending)
+            pending = []
+
+    with ProcessPoolExecutor(workers) as pool, open(rejects_path, 'w', newline='', encoding='utf-8-sig') as f:
+        rejects = csv.writer(f, delimiter=';')
+        rejects.writerow(['Файл', 'Строка', 'Причина', 'Исходные значения'])
+        in_flight = deque()
+
+        def reject(path, line, reason, row):
+            nonlocal rejected
+            rejects.writerow([path, line, reason, *row])
+            rejected += 1
+
+        def collect(future_info):
+            path, future = future_info
+            records, bad = future.result()
+            for line, reason, row in bad:
+                reject(path, line, reason, row)
+            # Повторный uid нарушил бы уникальность и откатил бы всю пачку insert_many
+            uids = {record['uid'] for _, record in records if record.get('uid')}
+            known = db.known_uids(uids - seen_uids) if uids else set()
+            for line, record in records:
+                uid = record.get('uid')
+                if uid and (uid in seen_uids or uid in known):
+                    reject(path, line, f'Запись с uid {uid} уже есть', [uid])
+                    continue
+                if uid:
+                    seen_uids.add(uid)
+                pending.append(record)
+            if len(pending) >= commit_size:
+                flush()
+            if progress:
+                progress(read, imported + len(pending), rejected, time.perf_counter() - started)
+
+        for path in paths:
+            # Ошибки чтения файла (любые: битый XLSX, кодировка, нет колонок) отклоняют только
+            # этот файл; ошибки пула и записи в БД по-прежнему прерывают импорт
+            try:
+                rows = read_rows(path)
+                headers = next(rows, None)
+                if headers is None:
+                    continue
+                mapping = map_headers(headers, defect_types)
+            except Exception as e:
+                reject(path, 1, f'Файл не импортирован: {e}', [])
+                continue
+
+            line = 2
+            chunk = []
+            while True:
+                try:
+                    row = next(rows, None)
+                except Exception as e:
+                    # Строки, прочитанные до ошибки, импортируются, остаток файла пропускается
+                    reject(path, line + len(chunk), f'Файл прочитан не полностью: {e}', [])
+                    break
+                if row is None:
+                    break
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    in_flight.append((path, pool.submit(validate_chunk, mapping, line, chunk)))
+                    read += len(chunk)
+                    line += len(chunk)
+                    chunk = []
+                    # Ограничиваем число пачек в работе, чтобы память не росла с размером файла
+                    while len(in_flight) > workers * 2:
+                        collect(in_flight.popleft())
+            if chunk:
+                in_flight.append((path, pool.submit(validate_chunk, mapping, line, chunk)))
+                read += len(chunk)
+
+        while in_flight:
+            collect(in_flight.popleft())
+        flush()
+
+    elapsed = time.perf_counter() - started
+    if progress:
+        progress(read, imported, rejected, elapsed)
+    return imported, rejected, elapsed
@@ -0,0 +1,233 @@
+import glob
+import os
+import re
+import sqlite3
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+from database import HEADER_COLUMNS
+
+# Архивные записи хранятся по годам даты приемки рядом с основной БД: castings_archive_2021.db
+ARCHIVE_SUFFIX = '_archive_'
+
+
+def archive_path(db, year):
+    stem, _ = os.path.splitext(db.db_name)
+    return f'{stem}{ARCHIVE_SUFFIX}{year}.db'
+
+
+def archive_paths(db):
+    """Существующие архивы БД: {год: путь}"""
+    stem, _ = os.path.splitext(db.db_name)
+    paths = {}
+    for path in glob.glob(glob.escape(stem + ARCHIVE_SUFFIX) + '*.db'):
+        match = re.search(r'_(\d{4})\.db$', path)
+        if match:
+            paths[match.group(1)] = path
+    return dict(sorted(paths.items()))
+
+
+def _create_archive_schema(conn, alias):
+    # Те же заголовки и дефекты, что в основной БД, но без триггеров, сводок и журнала
+    header = ',\n'.join(f'{column} {"INTEGER" if column in ("Контроль_подано", "Контроль_принято") else "TEXT"}'
+                        for column in HEADER_COLUMNS)
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {alias}.inspections (
+        ID INTEGER PRIMARY KEY,
+        uid TEXT UNIQUE,
+        {header}
+    )
+    ''')
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {alias}.inspection_defects (
+        inspection_id INTEGER NOT NULL,
+        defect_code TEXT NOT NULL,
+        qty INTEGER NOT NULL,
+        PRIMARY KEY (inspection_id, defect_code)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {alias}.defect_types (
+        code TEXT PRIMARY KEY,
+        category TEXT NOT NULL,
+        label TEXT NOT NULL,
+        position INTEGER NOT NULL
+    )
+    ''')
+    conn.execute(f'''
+    CREATE INDEX IF NOT EXISTS {alias}.idx_inspections_name_date
+    ON inspections (Наименование_отливки, Контроль_дата_приемки)
+    ''')
+    # Справочник копируется целиком, чтобы архив можно было читать без основной БД
+    conn.execute(f'INSERT OR REPLACE INTO {alias}.defect_types SELECT code, category, label, position FROM main.defect_types')
+    conn.commit()
+
+
+def archive_records(db, before, batch_size=5000, progress=None, force=False):
+    """Переносит записи с датой приемки раньше before в архивы по годам.
+
+    Каждая пачка сначала копируется в архив (INSERT OR IGNORE по ID), а затем удаляется
+    из основной БД отдельной транзакцией - только если она уже есть в архиве. При сбое
+    между транзакциями запись остается в обеих БД, и повторный запуск просто ее удалит.
+    Сводки по дням не меняются (у них нет триггеров на удаление), поэтому отчеты
+    по-прежнему охватывают всю историю. Перенесенную запись журнал изменений уже не отдает
+    при синхронизации, поэтому на терминале (БД, которая передает журнал в центральную,
+    Database.synced_position не None) переносятся только уже переданные записи;
+    force=True снимает это ограничение. Центральная БД архивируется только по дате.
+    Возвращает (перенесено записей, оставлено несинхронизированных записей).
+    """
+    conn = db.get_connection()
+    # Последний ID, уже переданный в центральную БД (ID растут вместе с позицией журнала);
+    # -1 - без ограничения
+    max_id = -1
+    held = 0
+    synced = db.synced_position()
+    if not force and synced is not None:
+        max_id = conn.execute(
+            'SELECT coalesce(MAX(inspection_id), 0) FROM change_journal WHERE seq <= ?', (synced,)
+        ).fetchone()[0]
+        held = conn.execute(
+            'SELECT COUNT(*) FROM inspections WHERE Контроль_дата_приемки < ? AND ID > ?', (before, max_id)
+        ).fetchone()[0]
+    years = [row[0] for row in conn.execute('''
+    SELECT DISTINCT substr(Контроль_дата_приемки, 1, 4) FROM inspections
+    WHERE Контроль_дата_приемки < ? AND Контроль_дата_приемки GLOB '[0-9][0-9][0-9][0-9]-*'
+      AND (? < 0 OR ID <= ?)
+    ''', (before, max_id, max_id))]
+    header = ', '.join(HEADER_COLUMNS)
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (ID INTEGER PRIMARY KEY)')
+
+    moved = 0
+    for year in years:
+        conn.execute('ATTACH DATABASE ? AS archive', (archive_path(db, year),))
+        try:
+            _create_archive_schema(conn, 'archive')
+            date_to = min(before, f'{int(year) + 1}-01-01')
+            while True:
+                conn.execute('DELETE FROM archive_batch')
+                conn.execute('''
+                INSERT INTO archive_batch (ID)
+                SELECT ID FROM main.inspections
+                WHERE Контроль_дата_приемки >= ? AND Контроль_дата_приемки < ? AND (? < 0 OR ID <= ?)
+                ORDER BY Контроль_дата_приемки
+                LIMIT ?
+                ''', (f'{year}-01-01', date_to, max_id, max_id, batch_size))
+                conn.commit()
+                count = conn.execute('SELECT COUNT(*) FROM archive_batch').fetchone()[0]
+                if not count:
+                    break
+
+                conn.execute('BEGIN')
+                try:
+                    conn.execute(f'''
+                    INSERT OR IGNORE INTO archive.inspections (ID, uid, {header})
+                    SELECT ID, uid, {header} FROM main.inspections WHERE ID IN (SELECT ID FROM archive_batch)
+                    ''')
+                    conn.execute('''
+                    INSERT OR IGNORE INTO archive.inspection_defects (inspection_id, defect_code, qty)
+                    SELECT inspection_id, defect_code, qty FROM main.inspection_defects
+                    WHERE inspection_id IN (SELECT ID FROM archive_batch)
+                    ''')
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+
+                # Дефекты удаляются раньше заголовков (внешние ключи), индекс FTS чистит триггер
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    archived = 'SELECT ID FROM archive_batch WHERE ID IN (SELECT ID FROM archive.inspections)'
+                    conn.execute(f'DELETE FROM main.inspection_defects WHERE inspection_id IN ({archived})')
+                    moved += conn.execute(f'DELETE FROM main.inspections WHERE ID IN ({archived})').rowcount
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                if progress:
+                    progress(year, moved)
+        finally:
+            conn.execute('DETACH DATABASE archive')
+    conn.execute('DROP TABLE temp.archive_batch')
+    return moved, held
+
+
+def attach_archives(db, conn=None):
+    """Подключает архивы (ATTACH, только чтение) и создает временные представления
+    all_inspections и all_inspection_defects - живые записи вместе с архивными.
+
+    По умолчанию используется соединение для чтения текущего потока. Возвращает
+    список подключенных лет; если архивов больше лимита SQLite, подключаются последние.
+    """
+    # Соединение для чтения открыто с URI, поэтому архивы подключаются тоже только для чтения
+    readonly = conn is None
+    conn = conn or db.get_read_connection()
+    years = list(archive_paths(db).items())
+    attached = {row[1] for row in conn.execute('PRAGMA database_list')}
+    others = attached - {'main', 'temp'} - {f'archive_{year}' for year, _ in years}
+    limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(conn, 'getlimit') else 10
+    available = limit - len(others)
+    years = years[-available:] if available > 0 else []
+
+    for year, path in years:
+        alias = f'archive_{year}'
+        if alias not in attached:
+            target = Path(path).resolve().as_uri() + '?mode=ro' if readonly else os.path.abspath(path)
+            conn.execute(f'ATTACH DATABASE ? AS {alias}', (target,))
+
+    header = ', '.join(HEADER_COLUMNS)
+    inspections = [f"SELECT ID, uid, {header}, 'live' AS source FROM main.inspections"]
+    defects = ['SELECT inspection_id, defect_code, qty FROM main.inspection_defects']
+    for year, _ in years:
+        inspections.append(f"SELECT ID, uid, {header}, '{year}' FROM archive_{year}.inspections")
+        defects.append(f'SELECT inspection_id, defect_code, qty FROM archive_{year}.inspection_defects')
+    conn.execute('DROP VIEW IF EXISTS temp.all_inspections')
+    conn.execute('DROP VIEW IF EXISTS temp.all_inspection_defects')
+    conn.execute('CREATE TEMP VIEW all_inspections AS ' + ' UNION ALL '.join(inspections))
+    conn.execute('CREATE TEMP VIEW all_inspection_defects AS ' + ' UNION ALL '.join(defects))
+    return [year for year, _ in years]
+
+
+def file_size(path):
+    """Размер файла БД вместе с WAL"""
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def compact(db):
+    """Освобождает место и обновляет статистику планировщика.
+
+    При первом запуске БД переводится в auto_vacuum=INCREMENTAL (требует одного полного
+    VACUUM), дальше свободные страницы возвращаются через PRAGMA incremental_vacuum.
+    Возвращает количество освобожденных страниц.
+    """
+    conn = db.get_connection()
+    conn.commit()
+    free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    else:
+        # Через execute модуль sqlite3 делает только один шаг incremental_vacuum
+        # (одна страница), executescript выполняет его до конца
+        conn.executescript('PRAGMA incremental_vacuum;')
+    free_after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA optimize')
+    conn.commit()
+    # Перенос WAL в основной файл и обрезка WAL, иначе освобожденное место не видно на диске
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return free_before - free_after
+
+
+def maintain(db, keep_days=3 * 365, batch_size=5000, progress=None, force=False):
+    """Архивирование записей старше keep_days дней и сжатие БД.
+
+    Возвращает (перенесено записей, оставлено несинхронизированных, освобождено страниц,
+    размер до, размер после, секунд).
+    """
+    started = time.perf_counter()
+    size_before = file_size(db.db_name)
+    before = (date.today() - timedelta(days=keep_days)).isoformat()
+    moved, held = archive_records(db, before, batch_size, progress, force)
+    freed = compact(db)
+    return moved, held, freed, size_before, file_size(db.db_name), time.perf_counter() - started
@@ -0,0 +1,216 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+# Границы корзин гистограмм длительности, секунды
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Порог медленной операции по умолчанию и отдельные пороги по именам метрик, секунды
+SLOW_THRESHOLD = 0.1
+SLOW_THRESHOLDS = {
+    'ui_on_change_seconds': 0.016,  # обработчик поля не должен задерживать кадр
+    'db_get_connection_seconds': 0.05,
+}
+
+
+class _NoTimer:
+    """Пустой контекст замера, когда метрики выключены"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Metrics:
+    """Счетчики и гистограммы длительности операций (сохранение, запросы, обработчики формы).
+
+    Включается переменной окружения CASTINGQC_METRICS=<файл>: при выходе из приложения
+    метрики записываются в этот файл (.prom/.txt - текстовый формат Prometheus, иначе JSON).
+    CASTINGQC_TRACE_SQL=1 (или путь к файлу) дополнительно включает трассировку SQL-запросов.
+    В выключенном состоянии замер стоит одну проверку флага.
+    """
+
+    def __init__(self, path=None, trace_sql=None, slow_stream=None):
+        self.path = path
+        self.enabled = bool(path)
+        self.trace_sql = trace_sql
+        self.slow_stream = slow_stream or sys.stderr
+        self.lock = threading.Lock()
+        self.counters = {}
+        # (имя, метки) -> [счетчики по корзинам, сумма, количество, максимум]
+        self.histograms = {}
+        self.slow = deque(maxlen=200)
+        self.trace_file = None
+
+    def enable(self, path=None):
+        self.enabled = True
+        self.path = path or self.path
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.slow.clear()
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Добавляет длительность операции в гистограмму и проверяет порог медленной операции"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0, 0.0]
+            histogram[0][bisect_left(BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            histogram[3] = max(histogram[3], seconds)
+
+        if seconds >= SLOW_THRESHOLDS.get(name, SLOW_THRESHOLD):
+            entry = (time.strftime('%Y-%m-%dT%H:%M:%S'), name, dict(labels), seconds)
+            self.slow.append(entry)
+            print(f'Медленная операция: {name} {_format_labels(labels)} {seconds * 1000:.1f} мс',
+                  file=self.slow_stream)
+
+    def timer(self, name, **labels):
+        """Контекст замера длительности: with METRICS.timer('db_commit_seconds'): ..."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name, labels)
+
+    def timed(self, name):
+        """Декоратор замера длительности вызова функции"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def install_trace(self, conn):
+        """Подключает трассировку SQL к соединению (если включена)"""
+        if self.trace_sql:
+            conn.set_trace_callback(self._trace)
+
+    def _trace(self, statement):
+        # Вызывается sqlite3 для каждого выполняемого оператора, в потоке соединения
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+        self.count('sql_statements_total', kind=kind)
+        with self.lock:
+            if self.trace_file is None:
+                if self.trace_sql in ('1', True):
+                    self.trace_file = sys.stderr
+                else:
+                    self.trace_file = open(self.trace_sql, 'a', encoding='utf-8')
+            print(f'{time.time():.6f} {threading.current_thread().name}: {statement}', file=self.trace_file)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {
+                        'name': name,
+                        'labels': dict(labels),
+                        'count': count,
+                        'sum_s': total,
+                        'max_s': maximum,
+                        'buckets': dict(zip([*map(str, BUCKETS), '+Inf'], buckets)),
+                    }
+                    for (name, labels), (buckets, total, count, maximum) in sorted(self.histograms.items())
+                ],
+                'slow': [
+                    {'time': stamp, 'name': name, 'labels': labels, 'seconds': seconds}
+                    for stamp, name, labels, seconds in self.slow
+                ],
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self):
+        """Метрики в текстовом формате Prometheus (для node_exporter textfile collector и т.п.)"""
+        data = self.snapshot()
+        lines = []
+        for name in sorted({item['name'] for item in data['counters']}):
+            lines.append(f'# TYPE castingqc_{name} counter')
+            for item in data['counters']:
+                if item['name'] == name:
+                    lines.append(f'castingqc_{name}{_format_labels(item["labels"])} {item["value"]}')
+        for name in sorted({item['name'] for item in data['histograms']}):
+            lines.append(f'# TYPE castingqc_{name} histogram')
+            for item in data['histograms']:
+                if item['name'] != name:
+                    continue
+                cumulative = 0
+                for bound, value in item['buckets'].items():
+                    cumulative += value
+                    labels = _format_labels({**item['labels'], 'le': bound})
+                    lines.append(f'castingqc_{name}_bucket{labels} {cumulative}')
+                labels = _format_labels(item['labels'])
+                lines.append(f'castingqc_{name}_sum{labels} {item["sum_s"]}')
+                lines.append(f'castingqc_{name}_count{labels} {item["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path=None):
+        """Записывает метрики в файл; формат выбирается по расширению"""
+        path = path or self.path
+        if not path or not self.enabled:
+            return
+        text = self.to_prometheus() if path.endswith(('.prom', '.txt')) else self.to_json() + '\n'
+        # Запись через временный файл, чтобы сборщик не прочитал файл наполовину
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+METRICS = Metrics(os.environ.get('CASTINGQC_METRICS'), os.environ.get('CASTINGQC_TRACE_SQL'))
@@ -0,0 +1,356 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from database import Database
+from fields import BASIC_FIELDS, DEFECT_CATEGORIES, NOTES_COLUMN
+
+# Строк в одном фрагменте потокового ответа и фрагментов в очереди до записи в сокет
+STREAM_BATCH = 1000
+STREAM_QUEUE = 8
+MAX_HEADER_SIZE = 16 * 1024
+# Не больше стольких ответов в кэше, даже если они еще не устарели
+CACHE_SIZE = 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+def _int_param(params, name, default, maximum):
+    try:
+        value = int(params.get(name, default))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f'Параметр {name} должен быть целым числом')
+    if not 0 < value <= maximum:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f'Параметр {name} должен быть от 1 до {maximum}')
+    return value
+
+
+def _date_param(params, name, default=None):
+    value = params.get(name)
+    if not value:
+        return default
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f'Параметр {name}: ожидается дата гггг-мм-дд')
+
+
+def _choice_param(params, name, choices):
+    value = params.get(name, choices[0])
+    if value not in choices:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f'Параметр {name}: одно из {", ".join(choices)}')
+    return value
+
+
+class ReportServer:
+    """Сервис отчетов по HTTP/JSON только для чтения.
+
+    Запросы к SQLite выполняются в пуле потоков; у каждого потока свое соединение только
+    для чтения (Database.get_read_connection), поэтому в режиме WAL отчеты не мешают
+    терминалам писать. Ответы кэшируются на ttl секунд и сбрасываются, как только в БД
+    появились изменения: версия БД (PRAGMA data_version и последняя позиция журнала)
+    проверяется в фоне раз в poll_interval секунд. Ключ кэша строится только из параметров,
+    которые понимает отчет. Одинаковые одновременные запросы ждут один общий запрос к БД.
+    Выгрузка записей за период отдается потоком (Transfer-Encoding: chunked) без кэширования,
+    не больше streams выгрузок одновременно.
+    """
+
+    def __init__(self, db, workers=8, ttl=30.0, poll_interval=1.0, streams=4):
+        self.db = db
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='report')
+        # Поток выгрузки занят, пока клиент читает ответ, поэтому выгрузки идут в своем
+        # ограниченном пуле: медленные клиенты не занимают потоки отчетов
+        self.max_streams = streams
+        self.active_streams = 0
+        self.stream_pool = ThreadPoolExecutor(max_workers=streams, thread_name_prefix='report-stream')
+        # data_version сравнима только в пределах одного соединения, поэтому версия
+        # всегда читается в одном и том же отдельном потоке
+        self.version_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='report-version')
+        self.version = None
+        # ключ запроса -> (версия БД, время, future с готовым телом ответа)
+        self.cache = {}
+        # путь -> (обработчик, параметры, от которых зависит ответ)
+        self.routes = {
+            '/api/recent': (self.recent, ('limit',)),
+            '/api/castings': (self.castings, ('days',)),
+            '/api/summary': (self.summary, ('from', 'to', 'group', 'period')),
+            '/api/pareto': (self.pareto, ('days', 'casting', 'controller')),
+        }
+        self.streams = {
+            '/api/records': self.records,
+        }
+
+    def data_version(self):
+        # Выполняется в потоке version_pool: оба запроса читают только заголовок БД
+        # и индекс первичного ключа, без обращения к таблицам с данными
+        conn = self.db.get_read_connection()
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        seq = conn.execute('SELECT max(seq) FROM change_journal').fetchone()[0]
+        return version, seq
+
+    # Отчеты: выполняются в пуле потоков, возвращают данные для json.dumps
+
+    def recent(self, params):
+        return self.db.recent_inspections(_int_param(params, 'limit', 50, 500))
+
+    def castings(self, params):
+        days = _int_param(params, 'days', 30, 100 * 365)
+        since = (date.today() - timedelta(days=days - 1)).isoformat()
+        keys = ['inspections', 'submitted', 'accepted'] + [category for category, _ in DEFECT_CATEGORIES]
+        totals = {}
+        for casting, metric, qty in self.db.casting_totals(since):
+            totals.setdefault(casting, dict.fromkeys(keys, 0))[metric] = qty
+        return [{'casting': casting, **values} for casting, values in sorted(totals.items())]
+
+    def summary(self, params):
+        date_to = _date_param(params, 'to', date.today().isoformat())
+        date_from = _date_param(params, 'from', (date.fromisoformat(date_to) - timedelta(days=29)).isoformat())
+        group = _choice_param(params, 'group', ['casting', 'controller'])
+        period = _choice_param(params, 'period', ['day', 'week', 'month'])
+        names = [group, 'period', 'submitted', 'accepted', 'second_grade', 'rework', 'final']
+        return [dict(zip(names, row)) for row in self.db.defect_summary(date_from, date_to, group, period)]
+
+    def pareto(self, params):
+        days = _int_param(params, 'days', 30, 100 * 365)
+        if params.get('casting') is not None and params.get('controller') is not None:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, 'Укажите либо casting, либо controller')
+        rows = self.db.defect_pareto(days, casting=params.get('casting'), controller=params.get('controller'))
+        return [
+            {'defect': metric, 'qty': qty, 'share': share, 'cumulative': cumulative}
+            for metric, qty, share, cumulative in rows
+        ]
+
+    def records(self, params):
+        """Генератор фрагментов JSON-массива с записями за период (в формате castings)"""
+        date_from = _date_param(params, 'from')
+        date_to = _date_param(params, 'to')
+
+        def chunks():
+            # Колонки в порядке строк iter_records
+            codes = [code for code, _, _ in self.db.defect_types()]
+            names = ['ID', *(column for column, _ in BASIC_FIELDS), *codes, NOTES_COLUMN]
+            yield b'['
+            batch = []
+            first = True
+            for row in self.db.iter_records(date_from, date_to, STREAM_BATCH):
+                batch.append(json.dumps(dict(zip(names, row)), ensure_ascii=False))
+                if len(batch) >= STREAM_BATCH:
+                    yield ((',' if not first else '') + ',\n'.join(batch)).encode()
+                    batch, first = [], False
+            if batch:
+                yield ((',' if not first else '') + ',\n'.join(batch)).encode()
+            yield b']\n'
+
+        return chunks()
+
+    # Кэш
+
+    async def refresh_version(self):
+        loop = asyncio.get_running_loop()
+        self.version = await loop.run_in_executor(self.version_pool, self.data_version)
+
+    async def poll_version(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.refresh_version()
+            except Exception:
+                # БД временно недоступна - сравниваем с прежней версией, кэш живет до ttl
+                pass
+
+    async def cached(self, path, params):
+        loop = asyncio.get_running_loop()
+        handler, names = self.routes[path]
+        params = {name: params[name] for name in names if name in params}
+        key = (path, tuple(sorted(params.items())))
+        version = self.version
+        now = time.monotonic()
+        entry = self.cache.get(key)
+        if entry and entry[0] == version and now - entry[1] < self.ttl:
+            return await entry[2]
+
+        def build():
+            return json.dumps(handler(params), ensure_ascii=False).encode()
+
+        future = loop.run_in_executor(self.pool, build)
+        if len(self.cache) >= CACHE_SIZE and key not in self.cache:
+            self.prune_cache()
+            if len(self.cache) >= CACHE_SIZE:
+                # Вытесняем самый старый ответ (словарь хранит порядок добавления)
+                del self.cache[next(iter(self.cache))]
+        self.cache[key] = (version, now, future)
+        try:
+            return await future
+        except Exception:
+            # Ошибки не кэшируем
+            if self.cache.get(key, (None, None, None))[2] is future:
+                del self.cache[key]
+            raise
+
+    def prune_cache(self):
+        now = time.monotonic()
+        for key in [key for key, (_, created, _) in self.cache.items() if now - created >= self.ttl]:
+            del self.cache[key]
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.send(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, {'error': 'Слишком большой запрос'})
+                    break
+
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ')
+                except ValueError:
+                    await self.send(writer, HTTPStatus.BAD_REQUEST, {'error': 'Некорректная строка запроса'})
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+                await self.dispatch(writer, method, target, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, writer, method, target, keep_alive):
+        url = urlsplit(target)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if method != 'GET':
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+            if url.path in self.routes:
+                body = await self.cached(url.path, params)
+                await self.send(writer, HTTPStatus.OK, body, keep_alive)
+            elif url.path in self.streams:
+                if self.active_streams >= self.max_streams:
+                    raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, 'Слишком много одновременных выгрузок, повторите позже')
+                self.active_streams += 1
+                try:
+                    await self.stream(writer, self.streams[url.path](params), keep_alive)
+                finally:
+                    self.active_streams -= 1
+            elif url.path in ('/', '/api'):
+                await self.send(writer, HTTPStatus.OK, {'endpoints': sorted([*self.routes, *self.streams])}, keep_alive)
+            else:
+                raise HTTPError(HTTPStatus.NOT_FOUND)
+        except HTTPError as e:
+            await self.send(writer, e.status, {'error': str(e)}, keep_alive)
+        except Exception as e:
+            await self.send(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)}, keep_alive)
+
+    @staticmethod
+    def _head(status, keep_alive, extra):
+        lines = [
+            f'HTTP/1.1 {status.value} {status.phrase}',
+            'Content-Type: application/json; charset=utf-8',
+            'Access-Control-Allow-Origin: *',
+            f'Connection: {"keep-alive" if keep_alive else "close"}',
+            *extra,
+        ]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def send(self, writer, status, body, keep_alive=False):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode()
+        writer.write(self._head(status, keep_alive, [f'Content-Length: {len(body)}']) + body)
+        await writer.drain()
+
+    async def stream(self, writer, chunks, keep_alive):
+        """Отправляет фрагменты генератора chunks по мере готовности.
+
+        Генератор целиком выполняется в одном потоке пула (курсор SQLite остается в своем
+        потоке), фрагменты передаются через ограниченную очередь - чтение из БД не уходит
+        далеко вперед медленного клиента.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(STREAM_QUEUE)
+        done = object()
+        cancelled = False
+
+        def produce():
+            try:
+                for chunk in chunks:
+                    if cancelled:
+                        break
+                    asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+            except Exception as e:
+                asyncio.run_coroutine_threadsafe(queue.put(e), loop).result()
+            finally:
+                chunks.close()
+                asyncio.run_coroutine_threadsafe(queue.put(done), loop).result()
+
+        # Первый фрагмент получаем до заголовков, чтобы ошибка запроса стала обычным ответом 500
+        producer = loop.run_in_executor(self.stream_pool, produce)
+        try:
+            item = await queue.get()
+            if isinstance(item, Exception):
+                raise item
+            writer.write(self._head(HTTPStatus.OK, keep_alive, ['Transfer-Encoding: chunked']))
+            while item is not done:
+                if isinstance(item, Exception):
+                    # Заголовки уже отправлены - обрываем соединение без завершающего фрагмента
+                    writer.close()
+                    raise ConnectionError(str(item))
+                if item:
+                    writer.write(b'%x\r\n%b\r\n' % (len(item), item))
+                    await writer.drain()
+                item = await queue.get()
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            cancelled = True
+            # Освобождаем поток-производитель, если он ждет места в очереди
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        await self.refresh_version()
+        poller = asyncio.create_task(self.poll_version())
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_SIZE, backlog=1024)
+        try:
+            async with server:
+                while True:
+                    await asyncio.sleep(self.ttl)
+                    self.prune_cache()
+        finally:
+            poller.cancel()
+
+
+def run(db_name, host='127.0.0.1', port=8080, workers=8, ttl=30.0, streams=4):
+    db = Database(db_name)
+    service = ReportServer(db, workers, ttl, streams=streams)
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.pool.shutdown()
+        service.version_pool.shutdown()
+        service.stream_pool.shutdown()
+        db.close()
@@ -0,0 +1,166 @@
+# Статистическое управление процессом: p-карты по категориям дефектов и u-карта
+# по всем дефектам для каждой отливки. Подгруппа - одна запись осмотра,
+# объем подгруппы - "Контроль подано".
+import math
+from collections import namedtuple
+from datetime import date, timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from fields import DEFECT_CATEGORIES
+
+CATEGORIES = [category for category, _ in DEFECT_CATEGORIES]
+
+# Сигнал о выходе точки за контрольные границы
+Signal = namedtuple('Signal', 'casting category chart value center lcl ucl')
+
+
+def p_limits(center, n, sigma=3.0):
+    """Границы p-карты (доля дефектных) для подгруппы объема n"""
+    # Дефектов может быть больше, чем подано (несколько дефектов на отливку), поэтому
+    # средняя доля ограничивается [0, 1], иначе под корнем получится отрицательное число
+    center = min(max(center, 0.0), 1.0)
+    spread = sigma * math.sqrt(center * (1 - center) / n)
+    return max(0.0, center - spread), min(1.0, center + spread)
+
+
+def u_limits(center, n, sigma=3.0):
+    """Границы u-карты (дефектов на единицу) для подгруппы объема n"""
+    spread = sigma * math.sqrt(center / n)
+    return max(0.0, center - spread), center + spread
+
+
+class SPCEngine:
+    """Инкрементальные контрольные карты для проверки каждой новой записи.
+
+    Для каждой отливки хранятся накопленные суммы (подано, дефекты по категориям),
+    поэтому проверка новой записи и обновление границ - O(число категорий),
+    без повторного чтения истории. Новая точка сравнивается с границами,
+    рассчитанными до ее добавления.
+    """
+
+    def __init__(self, defect_types, sigma=3.0, min_inspections=10):
+        # код дефекта -> категория
+        self.categories = {code: category for code, category, _ in defect_types}
+        self.sigma = sigma
+        # Пока записей по отливке меньше, границы считаются неустойчивыми
+        self.min_inspections = min_inspections
+        self.totals = {}
+
+    @classmethod
+    def from_database(cls, db, days=365, **kwargs):
+        """Начальные суммы за последние days дней берутся из сводных таблиц"""
+        engine = cls(db.defect_types(), **kwargs)
+        since = (date.today() - timedelta(days=days - 1)).isoformat() if days else None
+        for casting, metric, qty in db.casting_totals(since):
+            engine._totals(casting)[metric] = qty
+        return engine
+
+    def _totals(self, casting):
+        totals = self.totals.get(casting)
+        if totals is None:
+            totals = self.totals[casting] = dict.fromkeys(['inspections', 'submitted', *CATEGORIES], 0)
+        return totals
+
+    def observe(self, record):
+        """Проверяет новую запись по текущим границам и добавляет ее в суммы; возвращает [Signal]"""
+        casting = record.get('Наименование_отливки') or ''
+        n = record.get('Контроль_подано') or 0
+        counts = dict.fromkeys(CATEGORIES, 0)
+        for code, qty in record.get('defects', {}).items():
+            counts[self.categories.get(code, 'final')] += qty
+
+        totals = self._totals(casting)
+        signals = []
+        if n > 0 and totals['inspections'] >= self.min_inspections and totals['submitted'] > 0:
+            for category in CATEGORIES:
+                center = totals[category] / totals['submitted']
+                if center >= 1:
+                    # Доля не бывает больше 1 - p-карта для такой категории не имеет смысла
+                    continue
+                lcl, ucl = p_limits(center, n, self.sigma)
+                value = counts[category] / n
+                if value > ucl or value < lcl:
+                    signals.append(Signal(casting, category, 'p', value, center, lcl, ucl))
+
+            center = sum(totals[category] for category in CATEGORIES) / totals['submitted']
+            lcl, ucl = u_limits(center, n, self.sigma)
+            value = sum(counts.values()) / n
+            if value > ucl or value < lcl:
+                signals.append(Signal(casting, 'all', 'u', value, center, lcl, ucl))
+
+        totals['inspections'] += 1
+        totals['submitted'] += n
+        for category in CATEGORIES:
+            totals[category] += counts[category]
+        return signals
+
+
+def recompute(db, date_from=None, sigma=3.0, batch_size=50000):
+    """Пакетный расчет карт по всем отливкам (NumPy).
+
+    Данные читаются по колонкам, суммы по отливкам и границы каждой точки считаются
+    векторно. Возвращает список словарей: отливка, категория ('all' - u-карта),
+    тип карты, центральная линия, число точек и ID записей вне границ.
+    """
+    if np is None:
+        raise RuntimeError('Для пакетного расчета контрольных карт установите пакет numpy (pip install numpy)')
+
+    ids, castings, submitted, counts = [], [], [], []
+    cursor = db.category_counts(date_from)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        columns = list(zip(*rows))
+        ids.append(np.array(columns[0], dtype=np.int64))
+        castings.extend(value or '' for value in columns[1])
+        submitted.append(np.array([value or 0 for value in columns[2]], dtype=np.float64))
+        counts.append(np.array(columns[3:], dtype=np.float64).T)
+    if not ids:
+        return []
+
+    ids = np.concatenate(ids)
+    n = np.concatenate(submitted)
+    counts = np.concatenate(counts)
+    names, index = np.unique(np.array(castings, dtype=object), return_inverse=True)
+    valid = n > 0
+    safe_n = np.where(valid, n, 1)
+    n_sum = np.bincount(index, weights=np.where(valid, n, 0), minlength=len(names))
+    points = np.bincount(index, weights=valid, minlength=len(names))
+
+    charts = [(category, 'p', counts[:, i]) for i, category in enumerate(CATEGORIES)]
+    charts.append(('all', 'u', counts.sum(axis=1)))
+
+    results = []
+    for category, chart, defects in charts:
+        d_sum = np.bincount(index, weights=np.where(valid, defects, 0), minlength=len(names))
+        center = np.divide(d_sum, n_sum, out=np.zeros_like(d_sum), where=n_sum > 0)
+        point_center = center[index]
+        checked = valid
+        if chart == 'p':
+            # Как в SPCEngine.observe: при средней доле >= 1 p-карта не строится
+            checked = valid & (point_center < 1)
+            share = np.clip(point_center, 0, 1)
+            spread = sigma * np.sqrt(share * (1 - share) / safe_n)
+        else:
+            spread = sigma * np.sqrt(point_center / safe_n)
+        value = defects / safe_n
+        out = checked & ((value > point_center + spread) | (value < point_center - spread))
+
+        out_ids = {}
+        for position in np.flatnonzero(out):
+            out_ids.setdefault(index[position], []).append(int(ids[position]))
+        for i, casting in enumerate(names):
+            results.append({
+                'casting': casting,
+                'category': category,
+                'chart': chart,
+                'center': float(center[i]),
+                'points': int(points[i]),
+                'out_of_control': out_ids.get(i, []),
+            })
+    return results
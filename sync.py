@@ -0,0 +1,64 @@
+import time
+
+from database import Database
+
+
+def sync_databases(terminal, central, batch_size=1000, progress=None):
+    """Переносит в центральную БД новые записи терминала по его журналу изменений.
+
+    terminal и central - объекты Database. Каждая пачка добавляется одной транзакцией
+    вместе с новой позицией журнала, поэтому прерванную синхронизацию можно просто
+    запустить снова. Возвращает (прочитано из журнала, добавлено в центральную БД).
+    """
+    terminal_id = terminal.terminal_id
+    if terminal_id == central.terminal_id:
+        raise ValueError('Терминал и центральная база данных - это одна и та же БД')
+
+    # Виды дефектов, добавленные только на терминале, сначала переносим в справочник
+    known = {code for code, _, _ in central.defect_types()}
+    for code, category, label in terminal.defect_types():
+        if code not in known:
+            central.add_defect_type(code, category, label)
+
+    position, last_uid = central.sync_state(terminal_id)
+    if position:
+        # Копия файла другого терминала несет его terminal_id, но свой журнал: без проверки
+        # ее записи до чужой позиции были бы молча пропущены
+        entry = terminal.journal_entry(position)
+        if entry is None or (last_uid is not None and entry[0] is not None and entry[0] != last_uid):
+            raise ValueError(
+                f'Журнал терминала {terminal_id} не совпадает с уже объединенным в центральной БД '
+                f'(позиция {position}). Если файл скопирован с другого терминала, назначьте ему '
+                f'новый идентификатор командой new-terminal-id'
+            )
+    # С первой синхронизации БД считается терминалом: архивировать в ней можно только
+    # уже переданные записи
+    synced = terminal.synced_position()
+    if synced is None or position > synced:
+        terminal.mark_synced(position)
+    scanned = merged = 0
+    while True:
+        records, last_seq = terminal.journal_since(position, batch_size)
+        if last_seq is None:
+            break
+        entry = terminal.journal_entry(last_seq)
+        merged += central.merge_records(terminal_id, records, last_seq, entry[0] if entry else None)
+        # Позиция на терминале нужна архивированию: переносить можно только то, что уже в центре
+        terminal.mark_synced(last_seq)
+        scanned += len(records)
+        position = last_seq
+        if progress:
+            progress(scanned, merged)
+    return scanned, merged
+
+
+def sync_files(terminal_path, central_path, batch_size=1000, progress=None):
+    terminal = Database(terminal_path)
+    central = Database(central_path)
+    try:
+        started = time.perf_counter()
+        scanned, merged = sync_databases(terminal, central, batch_size, progress)
+        return scanned, merged, time.perf_counter() - started
+    finally:
+        terminal.close()
+        central.close()
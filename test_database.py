@@ -0,0 +1,52 @@
+import os
+import shutil
+import sqlite3
+
+from database import BULK_INSERT_MIN, Database
+
+
+def test_close_merges_wal_into_database_file(tmp_path):
+    path = str(tmp_path / 'castings.db')
+    db = Database(path)
+    db.insert_many([{'Наименование_отливки': 'Корпус', 'Контроль_подано': 1, 'defects': {}}] * 100)
+    # Соединение только для чтения открывается раньше закрытия, как в приложении и отчетах
+    db.recent_inspections(1)
+    db.close()
+
+    assert not os.path.exists(path + '-wal') or os.path.getsize(path + '-wal') == 0
+    # Копия одного файла БД (без -wal) содержит все записи
+    copy = str(tmp_path / 'copy.db')
+    shutil.copy(path, copy)
+    conn = sqlite3.connect(copy)
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM inspections').fetchone() == (100,)
+    finally:
+        conn.close()
+
+
+def test_bulk_insert_matches_per_row_triggers(tmp_path):
+    records = [
+        {'Наименование_отливки': f'Корпус {i % 7}' if i % 11 else None, 'Контролер1': f'Контролер {i % 3}',
+         'Контроль_подано': 10, 'Контроль_принято': i % 4, 'Контроль_дата_приемки': f'2024-02-{1 + i % 5:02d}',
+         'Примечание': 'трещина у прибыли' if i % 2 else '',
+         'defects': {'Второй_сорт_зарез': 1 + i % 2, 'Окончательный_брак_Трещины': i % 3}}
+        for i in range(BULK_INSERT_MIN + 100)
+    ]
+    bulk = Database(str(tmp_path / 'bulk.db'))
+    rows = Database(str(tmp_path / 'rows.db'))
+    try:
+        bulk.insert_many(records)
+        for start in range(0, len(records), 50):
+            rows.insert_many(records[start:start + 50])
+
+        for query in [
+            'SELECT * FROM rollup_casting_day ORDER BY 1, 2, 3',
+            'SELECT * FROM rollup_controller_day ORDER BY 1, 2, 3',
+            'SELECT seq, inspection_id FROM change_journal ORDER BY seq',
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' ORDER BY name",
+        ]:
+            assert bulk.get_connection().execute(query).fetchall() == rows.get_connection().execute(query).fetchall()
+        assert [row[0] for row in bulk.search('трещ', limit=1000)] == [row[0] for row in rows.search('трещ', limit=1000)]
+    finally:
+        bulk.close()
+        rows.close()
@@ -0,0 +1,32 @@
+import csv
+
+from database import Database
+from importer import import_files
+
+
+def test_bad_file_does_not_stop_import(tmp_path):
+    bad = tmp_path / 'bad.xlsx'
+    bad.write_bytes(b'not a zip archive')
+    good = tmp_path / 'good.csv'
+    good.write_text(
+        'Наименование отливки;Контроль подано;Дата приемки;uid\n'
+        'Корпус;5;2024-01-01;u1\n'
+        'Крышка;3;02.01.2024;u1\n'
+        'Втулка;3;02.01.2024;u2\n',
+        encoding='utf-8'
+    )
+    rejects_path = tmp_path / 'rejects.csv'
+
+    db = Database(str(tmp_path / 'castings.db'))
+    try:
+        imported, rejected, _ = import_files(db, [str(bad), str(good)], str(rejects_path), workers=1)
+        assert (imported, rejected) == (2, 2)
+        names = db.get_connection().execute('SELECT Наименование_отливки FROM inspections ORDER BY ID').fetchall()
+        assert names == [('Корпус',), ('Втулка',)]
+    finally:
+        db.close()
+
+    with open(rejects_path, newline='', encoding='utf-8-sig') as f:
+        rows = list(csv.reader(f, delimiter=';'))[1:]
+    # Битый файл отклонен целиком, повторный uid - одной строкой
+    assert [(row[0], row[1]) for row in rows] == [(str(bad), '1'), (str(good), '3')]
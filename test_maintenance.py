@@ -0,0 +1,58 @@
+from database import Database
+from maintenance import archive_paths, archive_records, compact
+from sync import sync_databases
+
+
+def rollups(db):
+    return db.get_connection().execute(
+        'SELECT casting, day, metric, qty FROM rollup_casting_day ORDER BY 1, 2, 3'
+    ).fetchall()
+
+
+def test_archive_keeps_unsynced_records_and_rollups(tmp_path):
+    terminal = Database(str(tmp_path / 'terminal.db'))
+    central = Database(str(tmp_path / 'central.db'))
+    try:
+        old = [
+            {'Наименование_отливки': f'Корпус {i}', 'Примечание': 'x' * 500, 'Контроль_подано': 5,
+             'Контроль_дата_приемки': f'{2019 + i % 2}-01-10', 'defects': {'Второй_сорт_зарез': 1}}
+            for i in range(2000)
+        ]
+        # Первая синхронизация делает БД терминалом, даже если передавать пока нечего
+        sync_databases(terminal, central)
+        terminal.insert_many(old)
+
+        # Ничего еще не передано в центральную БД - архивировать нечего
+        assert archive_records(terminal, '2023-01-01') == (0, 2000)
+
+        sync_databases(terminal, central)
+        terminal.insert_record(old[0])
+        assert archive_records(terminal, '2023-01-01') == (2000, 1)
+        assert list(archive_paths(terminal)) == ['2019', '2020']
+        assert compact(terminal) > 0
+
+        # Пересчет сводок учитывает архивные записи
+        expected = rollups(terminal)
+        terminal.rebuild_rollups()
+        assert rollups(terminal) == expected
+
+        assert archive_records(terminal, '2023-01-01', force=True) == (1, 0)
+    finally:
+        terminal.close()
+        central.close()
+
+
+def test_archive_central_database_by_date_only(tmp_path):
+    terminal = Database(str(tmp_path / 'terminal.db'))
+    central = Database(str(tmp_path / 'central.db'))
+    try:
+        terminal.insert_many([
+            {'Наименование_отливки': 'Корпус', 'Контроль_подано': 5, 'Контроль_дата_приемки': '2019-05-01'}
+        ] * 50)
+        sync_databases(terminal, central)
+        # Центральная БД свой журнал никуда не передает - ограничение по синхронизации к ней не относится
+        assert central.synced_position() is None
+        assert archive_records(central, '2023-01-01') == (50, 0)
+    finally:
+        terminal.close()
+        central.close()
@@ -0,0 +1,144 @@
+import shutil
+import sqlite3
+
+import pytest
+
+from database import Database, HEADER_COLUMNS, LEGACY_DEFECT_COLUMNS, MIGRATIONS
+from sync import sync_databases
+
+
+def record(name, day='2024-03-01', submitted=10, defects=None):
+    return {
+        'Наименование_отливки': name,
+        'Контролер1': 'Иванов',
+        'Контроль_подано': submitted,
+        'Контроль_дата_приемки': day,
+        'Контроль_принято': submitted - sum((defects or {}).values()),
+        'defects': defects or {},
+    }
+
+
+def names(db):
+    return sorted(row[0] for row in db.get_connection().execute('SELECT Наименование_отливки FROM inspections'))
+
+
+def test_sync_is_idempotent_and_incremental(tmp_path):
+    terminal = Database(str(tmp_path / 'terminal.db'))
+    central = Database(str(tmp_path / 'central.db'))
+    try:
+        terminal.insert_many([record('A', defects={'Второй_сорт_зарез': 2}), record('B')])
+
+        assert sync_databases(terminal, central) == (2, 2)
+        assert central.sync_position(terminal.terminal_id) == 2
+        # Повторная синхронизация без новых записей ничего не добавляет
+        assert sync_databases(terminal, central) == (0, 0)
+        assert names(central) == ['A', 'B']
+
+        terminal.insert_record(record('C'))
+        assert sync_databases(terminal, central, batch_size=1) == (1, 1)
+        assert central.sync_position(terminal.terminal_id) == 3
+        assert names(central) == ['A', 'B', 'C']
+
+        # Дефекты и uid переносятся вместе с заголовком
+        conn = central.get_connection()
+        assert conn.execute('SELECT Второй_сорт_зарез FROM castings WHERE Наименование_отливки = ?', ('A',)).fetchone() == (2,)
+        uids = 'SELECT uid FROM inspections ORDER BY uid'
+        assert conn.execute(uids).fetchall() == terminal.get_connection().execute(uids).fetchall()
+
+        # Повтор уже объединенной пачки (например, после сбоя до сдвига позиции) безопасен
+        records, last_seq = terminal.journal_since(0)
+        assert central.merge_records(terminal.terminal_id, records, last_seq) == 0
+        assert names(central) == ['A', 'B', 'C']
+    finally:
+        terminal.close()
+        central.close()
+
+
+def test_migrations_from_wide_castings_table(tmp_path):
+    path = str(tmp_path / 'castings.db')
+    defect_columns = ''.join(f', {column} INTEGER' for column in LEGACY_DEFECT_COLUMNS)
+    conn = sqlite3.connect(path)
+    conn.execute(f'''
+    CREATE TABLE castings (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Наименование_отливки TEXT, Исполнитель1 TEXT, Исполнитель2 TEXT,
+        Контролер1 TEXT, Контролер2 TEXT, Контроль_подано INTEGER,
+        Контроль_дата_приемки DATE, Контроль_принято INTEGER{defect_columns},
+        Примечание TEXT
+    )
+    ''')
+    zeros = dict.fromkeys(LEGACY_DEFECT_COLUMNS, 0)
+    rows = [
+        {'Наименование_отливки': 'Корпус', 'Контроль_подано': 10, 'Контроль_дата_приемки': '05.03.2023',
+         'Контроль_принято': 7, 'Примечание': 'трещина у прибыли',
+         **zeros, 'Второй_сорт_раковины': 1, 'Окончательный_брак_Трещины': 2},
+        {'Наименование_отливки': 'Крышка', 'Контроль_подано': 4, 'Контроль_дата_приемки': '06.03.2023',
+         'Контроль_принято': 4, 'Примечание': '', **zeros},
+    ]
+    columns = list(rows[0])
+    conn.executemany(
+        f'INSERT INTO castings ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+        [[row[column] for column in columns] for row in rows]
+    )
+    conn.commit()
+    conn.close()
+
+    db = Database(path)
+    try:
+        conn = db.get_connection()
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        header = ', '.join(HEADER_COLUMNS)
+        assert conn.execute(f'SELECT ID, {header} FROM inspections ORDER BY ID').fetchall() == [
+            (1, 'Корпус', None, None, None, None, 10, '2023-03-05', 7, 'трещина у прибыли'),
+            (2, 'Крышка', None, None, None, None, 4, '2023-03-06', 4, ''),
+        ]
+        # Хранятся только ненулевые дефекты, широкое представление castings их восстанавливает
+        assert conn.execute('SELECT inspection_id, defect_code, qty FROM inspection_defects ORDER BY 2').fetchall() == [
+            (1, 'Второй_сорт_раковины', 1),
+            (1, 'Окончательный_брак_Трещины', 2),
+        ]
+        assert conn.execute(
+            'SELECT Второй_сорт_раковины, Окончательный_брак_Трещины, Доработка_лапы FROM castings WHERE ID = 1'
+        ).fetchone() == (1, 2, 0)
+        assert conn.execute(
+            "SELECT qty FROM rollup_casting_day WHERE casting = 'Корпус' AND day = '2023-03-05' AND metric = 'submitted'"
+        ).fetchone() == (10,)
+        # Журнал, uid и полнотекстовый индекс заполнены для перенесенных записей
+        assert conn.execute('SELECT inspection_id FROM change_journal ORDER BY seq').fetchall() == [(1,), (2,)]
+        assert conn.execute('SELECT COUNT(DISTINCT uid) FROM inspections').fetchone() == (2,)
+        assert [row[0] for row in db.search('трещ')] == [1]
+
+        # Новые записи продолжают нумерацию после перенесенных
+        assert db.insert_record(record('Втулка')) == 3
+    finally:
+        db.close()
+
+
+def test_sync_refuses_copied_terminal_until_new_id(tmp_path):
+    first = Database(str(tmp_path / 'first.db'))
+    first.insert_many([record('A'), record('B')])
+    first.close()
+    shutil.copy(tmp_path / 'first.db', tmp_path / 'second.db')
+
+    first = Database(str(tmp_path / 'first.db'))
+    second = Database(str(tmp_path / 'second.db'))
+    central = Database(str(tmp_path / 'central.db'))
+    try:
+        assert first.terminal_id == second.terminal_id
+        first.insert_many([record(f'A{i}') for i in range(5)])
+        second.insert_many([record(f'B{i}') for i in range(4)])
+
+        assert sync_databases(first, central) == (7, 7)
+        # Копия с тем же terminal_id: ее записи до чужой позиции не должны пропасть молча
+        with pytest.raises(ValueError):
+            sync_databases(second, central)
+        assert second.synced_position() is None
+
+        second.new_terminal_id()
+        assert sync_databases(second, central) == (6, 4)
+        assert len(names(central)) == 11
+        assert second.synced_position() == 6
+    finally:
+        first.close()
+        second.close()
+        central.close()
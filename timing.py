@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+
+
+class StartupTrace:
+    """Отметки времени этапов запуска приложения.
+
+    Включается переменной окружения CASTINGQC_TRACE_STARTUP=1; отчет печатается в stderr.
+    Отсчет идет от импорта модуля, поэтому __main__ импортирует его первым.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.last = self.origin
+        self.marks = []
+
+    def mark(self, stage):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.marks.append((stage, now - self.last, now - self.origin))
+        self.last = now
+
+    def report(self, stream=None):
+        if not self.enabled:
+            return
+        stream = stream or sys.stderr
+        print('Запуск приложения (этап: длительность / с начала, мс):', file=stream)
+        for stage, duration, total in self.marks:
+            print(f'  {stage:<40} {duration * 1000:>8.1f} {total * 1000:>8.1f}', file=stream)
+
+
+STARTUP = StartupTrace(os.environ.get('CASTINGQC_TRACE_STARTUP') == '1')
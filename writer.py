@@ -0,0 +1,114 @@
+import queue
+import sys
+import threading
+import time
+import traceback
+
+from metrics import METRICS
+
+# Служебные маркеры очереди
+_FLUSH = object()
+_STOP = object()
+
+
+class BackgroundWriter:
+    """Фоновая запись в БД: копит записи и сохраняет их пачками в отдельном потоке"""
+
+    def __init__(self, db, batch_size=50, flush_interval=0.5, on_error=None, on_saved=None):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Колбэки вызываются из фонового потока:
+        # on_error(row, exc) - для каждой записи, которую не удалось сохранить
+        # on_saved(rows) - после успешного commit пачки
+        self.on_error = on_error
+        self.on_saved = on_saved
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, data):
+        """Ставит запись в очередь на сохранение и сразу возвращает управление"""
+        if self.closed:
+            raise RuntimeError('Фоновая запись уже остановлена')
+        if not self.thread.is_alive():
+            raise RuntimeError('Поток фоновой записи завершился с ошибкой, запись не сохранена')
+        self.queue.put(data)
+        METRICS.count('writer_submitted_total')
+
+    def flush(self):
+        """Блокирует до тех пор, пока все поставленные записи не будут сохранены"""
+        if self.thread.is_alive():
+            self.queue.put(_FLUSH)
+            self.queue.join()
+
+    def close(self):
+        """Сохраняет оставшиеся записи и останавливает поток (вызывается при выходе)"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is _STOP:
+                self.queue.task_done()
+                break
+            if item is _FLUSH:
+                self.queue.task_done()
+                continue
+
+            # Собираем пачку: до batch_size записей или до истечения окна flush_interval
+            batch = [item]
+            markers = 0
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _FLUSH or item is _STOP:
+                    markers += 1
+                    stop = item is _STOP
+                    break
+                batch.append(item)
+
+            self._write(batch)
+            for _ in range(len(batch) + markers):
+                self.queue.task_done()
+
+    @METRICS.timed('writer_batch_seconds')
+    def _write(self, batch):
+        try:
+            self.db.insert_many(batch)
+        except Exception:
+            # Пачка откатилась целиком - сохраняем по одной, чтобы найти сбойные записи
+            saved = []
+            for row in batch:
+                try:
+                    self.db.insert_record(row)
+                    saved.append(row)
+                except Exception as e:
+                    METRICS.count('writer_failed_total')
+                    if self.on_error:
+                        self._notify(self.on_error, row, e)
+            batch = saved
+        if batch and self.on_saved:
+            self._notify(self.on_saved, batch)
+
+    @staticmethod
+    def _notify(callback, *args):
+        # Ошибка в колбэке не должна останавливать поток записи: иначе следующие
+        # записи остались бы в очереди, которую никто не читает
+        try:
+            callback(*args)
+        except Exception:
+            METRICS.count('writer_callback_errors_total')
+            traceback.print_exc(file=sys.stderr)